@@ -3,9 +3,15 @@ Creates anchor based on the backbone
 Based on code from https://github.com/fastai/fastai_docs/blob/master/dev_nb/102a_coco.ipynb
 Author: Arka Sadhu
 """
+import inspect
 import torch
 import numpy as np
 from torch import nn
+import torch.nn.functional as F
+
+# register_buffer(persistent=) needs torch >= 1.6
+HAS_PERSISTENT = 'persistent' in inspect.signature(
+    nn.Module.register_buffer).parameters
 
 
 def cthw2tlbr(boxes):
@@ -63,7 +69,7 @@ def create_grid(size, flatten=True):
     return grid.view(-1, 2) if flatten else grid
 
 
-def create_anchors(sizes, ratios, scales, flatten=True, device=torch.device('cuda')):
+def create_anchors(sizes, ratios, scales, flatten=True, device=torch.device('cpu')):
     "Create anchor of `sizes`, `ratios` and `scales`."
     # device = torch.device('cuda')
     aspects = [[[s*np.sqrt(r), s*np.sqrt(1/r)]
@@ -169,10 +175,12 @@ def bbox_to_reg_params(anchors, boxes):
     """
     Converts boxes to corresponding reg params
     Assume both in rchw format
+    anchors: N x 4 shared by the batch or B x N x 4
     """
     boxes = tlbr2cthw(boxes)
     anchors = tlbr2cthw(anchors)
-    anchors = anchors.expand(boxes.size(0), anchors.size(0), 4)
+    if anchors.dim() == 2:
+        anchors = anchors.expand(boxes.size(0), anchors.size(0), 4)
     boxes = boxes.unsqueeze(1)
     trc = (boxes[..., :2] - anchors[..., :2]) / (anchors[..., 2:] + 1e-8)
     thw = torch.log(boxes[..., 2:] / (anchors[..., 2:] + 1e-8))
@@ -195,3 +203,253 @@ def reg_params_to_bbox(anchors, boxes, std12=[1, 1]):
     af = torch.cat([a111, a222], dim=2)
     aft = cthw2tlbr(af)
     return aft
+
+
+def create_att_targets(annot, resize_img, strides=[8, 16, 32]):
+    """
+    Creates the iou maps used as targets for the attention loss
+    annot: B x 4 gt boxes in r1c1r2c2 format, range -1 to 1
+    resize_img: size of the input image
+    Returns a list with one B x h x w map per stride.
+    The first map is computed directly, the others are
+    bilinearly resized from it.
+    """
+    # Box in pixels of the resized image
+    rstarget = (annot + 1) / 2 * resize_img[0]
+    size0 = resize_img[0] // strides[0]
+    # Center and size of the gt box in units of the first grid
+    t_ctr = (rstarget[:, :2] + rstarget[:, 2:]) / (2 * strides[0])
+    t_sz = (rstarget[:, 2:] - rstarget[:, :2]) / (2 * strides[0])
+
+    # Every grid point has a box of the gt size centered on it.
+    # Boxes are separable, so compute each axis independently
+    # B x 2 x S
+    pts = torch.arange(size0, dtype=annot.dtype,
+                       device=annot.device).view(1, 1, -1)
+    ctr = t_ctr.unsqueeze(-1)
+    half = t_sz.unsqueeze(-1) / 2
+    cell_lo = (pts - half).clamp(min=0)
+    cell_hi = (pts + half).clamp(max=size0)
+    inter = (torch.min(ctr + half, cell_hi) -
+             torch.max(ctr - half, cell_lo)).clamp(min=0)
+    cell_len = cell_hi - cell_lo
+
+    # B x S x S
+    inter_area = inter[:, 0, :, None] * inter[:, 1, None, :]
+    cell_area = cell_len[:, 0, :, None] * cell_len[:, 1, None, :]
+    gt_area = (t_sz[:, 0] * t_sz[:, 1]).view(-1, 1, 1)
+    smooth = 1e-7
+    iou_map = (inter_area + smooth) / (
+        gt_area + cell_area - inter_area + smooth)
+
+    iou_maps = [iou_map]
+    for stride in strides[1:]:
+        iou_maps.append(F.interpolate(
+            iou_map.unsqueeze(1),
+            size=(resize_img[1] // stride, resize_img[0] // stride),
+            mode='bilinear', align_corners=False).squeeze(1))
+    return iou_maps
+
+
+def get_ratios_scales(cfg):
+    "Anchor ratios and scales from the cfg strings, as in main_dist.py"
+    if type(cfg['ratios']) != list:
+        ratios = eval(cfg['ratios'], {})
+    else:
+        ratios = cfg['ratios']
+    if type(cfg['scales']) != list:
+        scales = cfg['scale_factor'] * np.array(eval(cfg['scales'], {}))
+    else:
+        scales = cfg['scale_factor'] * np.array(cfg['scales'])
+    return ratios, scales
+
+
+def get_feat_sizes(resize_img, mdl_to_use):
+    """
+    Sizes (h, w) of the feature maps given to the heads,
+    computed from the input size without running the model.
+    Every stride 2 conv / pool (kernel 3 pad 1, or 7 pad 3)
+    gives ceil(size / 2)
+    """
+    def down(size, times):
+        for _ in range(times):
+            size = (size + 1) // 2
+        return size
+
+    w, h = resize_img
+    if mdl_to_use == 'retina':
+        # c3, c4, c5 are at stride 8, 16, 32 then p6, p7 of FPN_backbone
+        sizes = [(down(h, k), down(w, k)) for k in range(3, 8)]
+        if list(resize_img) in [[600, 600], [608, 608]]:
+            return sizes[1:]
+        # p8 is pooled to 1 x 1
+        return sizes + [(1, 1)]
+    if mdl_to_use == 'realgin':
+        # Only the stride 32 map of darknet53
+        return [(down(h, 5), down(w, 5))]
+    raise NotImplementedError(
+        f'Feature sizes of {mdl_to_use} are not known')
+
+
+def input_hw(inp, cfg):
+    "Height, width of the input images of a batch"
+    if 'img' in inp:
+        h, w = inp['img'].shape[-2:]
+        return int(h), int(w)
+    # Features from the store are all of cfg.resize_img
+    w, h = cfg['resize_img']
+    return h, w
+
+
+class NonPersistentBuffers(nn.Module):
+    """
+    Module with buffers that are not in the state dict.
+    Before torch 1.6 they are plain attributes,
+    moved along with the buffers in _apply
+    """
+
+    def register_nonpersistent(self, name, tensor):
+        if HAS_PERSISTENT:
+            self.register_buffer(name, tensor, persistent=False)
+        else:
+            self.__dict__.setdefault('_nonpersistent', set()).add(name)
+            setattr(self, name, tensor)
+
+    def _apply(self, fn):
+        super()._apply(fn)
+        for name in self.__dict__.get('_nonpersistent', ()):
+            setattr(self, name, fn(getattr(self, name)))
+        return self
+
+
+class AnchorGrids(NonPersistentBuffers):
+    """
+    Grid centers of the feature maps (2 x H x W, as used by concat_we),
+    flattened anchors and the feat_sizes, num_f_out outputs of a list
+    of feature maps, made once per feature sizes and device.
+    Those of cfg.resize_img are made at build as non-persistent buffers
+    (see NonPersistentBuffers): they follow .to() and the DataParallel
+    replicas but are not in the state dict.
+    Other sizes (or devices) are added on first use
+    """
+
+    def __init__(self, ratios, scales, mdl_to_use, resize_img=None):
+        super().__init__()
+        self.ratios = list(ratios)
+        self.scales = list(scales)
+        self.mdl_to_use = mdl_to_use
+        # (name, device) -> tensor, for the ones not in the buffers
+        self.extra = {}
+        # (h, w) of the input -> feature sizes
+        self.sizes_of_input = {}
+        if resize_img is None:
+            return
+        try:
+            feat_sizes = get_feat_sizes(resize_img, mdl_to_use)
+        except NotImplementedError:
+            return
+        for size in feat_sizes:
+            self.register_nonpersistent(self.grid_name(size),
+                                        self.make_grid(size))
+        sizes_key = self.sizes_key(feat_sizes)
+        self.register_nonpersistent(f'anchs_{sizes_key}',
+                                    self.make_anchors(feat_sizes))
+        self.register_nonpersistent(f'sizes_{sizes_key}',
+                                    torch.tensor(feat_sizes))
+        self.register_nonpersistent(f'num_f_out_{len(feat_sizes)}',
+                                    torch.tensor([len(feat_sizes)]))
+
+    @staticmethod
+    def grid_name(size):
+        return 'grid_{}x{}'.format(*size)
+
+    @staticmethod
+    def sizes_key(feat_sizes):
+        return '_'.join('{}x{}'.format(*sz) for sz in feat_sizes)
+
+    @staticmethod
+    def make_grid(size):
+        return create_grid(tuple(size), flatten=False).permute(
+            2, 0, 1).contiguous()
+
+    def make_anchors(self, feat_sizes):
+        return create_anchors(feat_sizes, self.ratios, self.scales,
+                              flatten=True, device=torch.device('cpu'))
+
+    def lookup(self, name, make, device):
+        buf = getattr(self, name, None)
+        if buf is not None and buf.device == device:
+            return buf
+        key = (name, str(device))
+        if key not in self.extra:
+            self.extra[key] = make().to(device)
+        return self.extra[key]
+
+    def grid(self, size, device):
+        "2 x H x W grid centers of a feature map of `size`"
+        size = (int(size[0]), int(size[1]))
+        return self.lookup(self.grid_name(size),
+                           lambda: self.make_grid(size), device)
+
+    def anchors(self, feat_sizes, device):
+        "num_anchs x 4 anchors (r1c1r2c2) of all the feature maps"
+        feat_sizes = [(int(h), int(w)) for h, w in feat_sizes]
+        return self.lookup(f'anchs_{self.sizes_key(feat_sizes)}',
+                           lambda: self.make_anchors(feat_sizes), device)
+
+    def sizes_tensors(self, feat_sizes, device):
+        "feat_sizes (num_levels x 2) and num_f_out (1) as output by ZSGNet"
+        feat_sizes = [(int(h), int(w)) for h, w in feat_sizes]
+        sizes = self.lookup(f'sizes_{self.sizes_key(feat_sizes)}',
+                            lambda: torch.tensor(feat_sizes), device)
+        num_f_out = self.lookup(f'num_f_out_{len(feat_sizes)}',
+                                lambda: torch.tensor([len(feat_sizes)]),
+                                device)
+        return sizes, num_f_out
+
+    def feat_sizes(self, hw, out):
+        """
+        Feature sizes for inputs of height, width `hw`.
+        Computed on the host with get_feat_sizes, checked once against
+        the model output (read from it if the model is not known)
+        """
+        if hw not in self.sizes_of_input:
+            # In the case of DataParallel there is one per device
+            num_f_out = int(out['num_f_out'].view(-1)[0].item())
+            out_sizes = [tuple(sz) for sz in
+                         out['feat_sizes'][:num_f_out].tolist()]
+            try:
+                feat_sizes = get_feat_sizes(hw[::-1], self.mdl_to_use)
+                assert feat_sizes == out_sizes, (feat_sizes, out_sizes)
+            except NotImplementedError:
+                feat_sizes = out_sizes
+            self.sizes_of_input[hw] = feat_sizes
+        return self.sizes_of_input[hw]
+
+
+# One per anchor setting, shared by the model, loss and evaluator
+ANCHOR_GRIDS = {}
+
+
+def get_anchor_grids(cfg, ratios=None, scales=None):
+    "The AnchorGrids of cfg (ratios, scales of cfg if not given)"
+    if ratios is None or scales is None:
+        ratios, scales = get_ratios_scales(cfg)
+    key = (tuple(float(r) for r in ratios), tuple(float(s) for s in scales),
+           cfg['mdl_to_use'], tuple(cfg['resize_img']))
+    if key not in ANCHOR_GRIDS:
+        ANCHOR_GRIDS[key] = AnchorGrids(ratios, scales, cfg['mdl_to_use'],
+                                        cfg['resize_img'])
+    return ANCHOR_GRIDS[key]
+
+
+def assign_anchor_targets(anchs, annot, match_thr):
+    """
+    Anchor targets of a single gt box, as computed in ZSGLoss.
+    anchs: N x 4 flattened anchors, annot: 4, both r1c1r2c2
+    Returns the indices of the anchors with IoU > match_thr
+    and the index of the best anchor
+    """
+    ious = IoU_values(annot[None], anchs)[0]
+    pos_inds = torch.nonzero(ious > match_thr).view(-1)
+    return pos_inds, ious.argmax()
@@ -0,0 +1,108 @@
+"""
+Columnar store of the annotations of one csv file
+Converted once from the csv, then opened with mmap
+without parsing or creating python objects per row
+"""
+import json
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+def write_string_pool(store_dir: Path, name: str, strings: List[str]):
+    "Strings stored as utf-8 bytes and offsets into them"
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    np.save(store_dir / f'{name}_offsets.npy', offsets)
+    np.save(store_dir / f'{name}_bytes.npy',
+            np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+class StringPool:
+    "Read side of `write_string_pool`"
+
+    def __init__(self, store_dir: Path, name: str):
+        self.offsets = np.load(
+            store_dir / f'{name}_offsets.npy', mmap_mode='r')
+        self.data = np.load(store_dir / f'{name}_bytes.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ind: int) -> str:
+        st, end = self.offsets[ind], self.offsets[ind + 1]
+        return self.data[st:end].tobytes().decode('utf-8')
+
+
+class AnnotationStore:
+    """
+    Annotations of one csv file in numpy arrays
+    boxes: N x 4 float32 in x1y1x2y2 format
+    img_inds: N int32 index into the interned image ids
+    row_offsets: row_offsets[i]:row_offsets[i+1] are the queries of row i
+    """
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self.store_dir = Path(store_dir)
+        meta = json.load((self.store_dir / 'meta.json').open('r'))
+        # Whether the csv had a list of queries per row
+        self.query_is_list = meta['query_is_list']
+        self.boxes = np.load(self.store_dir / 'boxes.npy', mmap_mode='r')
+        self.img_inds = np.load(
+            self.store_dir / 'img_inds.npy', mmap_mode='r')
+        self.row_offsets = np.load(
+            self.store_dir / 'row_offsets.npy', mmap_mode='r')
+        self.img_ids = StringPool(self.store_dir, 'img_ids')
+        self.queries = StringPool(self.store_dir, 'queries')
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def get_queries(self, idx: int) -> List[str]:
+        return [self.queries[q] for q in
+                range(self.row_offsets[idx], self.row_offsets[idx + 1])]
+
+    def get_row(self, idx: int) -> Tuple:
+        """
+        Same fields as a row of the annotation dataframe:
+        img_id, x1, y1, x2, y2, queries
+        """
+        x1, y1, x2, y2 = self.boxes[idx]
+        queries = self.get_queries(idx)
+        if not self.query_is_list:
+            queries = queries[0]
+        return (self.img_ids[self.img_inds[idx]], x1, y1, x2, y2, queries)
+
+
+def build_ann_store(store_dir: Union[str, Path], ann_df: pd.DataFrame):
+    """
+    Converts the dataframe read by ImgQuDataset (img_id, x1, y1, x2, y2,
+    query columns) to the `AnnotationStore` format
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    img_col, query_col = ann_df.columns[0], ann_df.columns[-1]
+
+    boxes = ann_df[['x1', 'y1', 'x2', 'y2']].values.astype(np.float32)
+    np.save(store_dir / 'boxes.npy', boxes)
+
+    img_inds, img_ids = pd.factorize(ann_df[img_col].astype(str))
+    np.save(store_dir / 'img_inds.npy', img_inds.astype(np.int32))
+    write_string_pool(store_dir, 'img_ids', list(img_ids))
+
+    row_queries = [qs if isinstance(qs, list) else [qs]
+                   for qs in ann_df[query_col]]
+    row_offsets = np.zeros(len(row_queries) + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum([len(qs) for qs in row_queries])
+    np.save(store_dir / 'row_offsets.npy', row_offsets)
+    write_string_pool(store_dir, 'queries',
+                      [q for qs in row_queries for q in qs])
+
+    meta = {
+        'num_rows': len(ann_df),
+        'query_is_list': isinstance(ann_df[query_col].iloc[0], list)
+    }
+    json.dump(meta, (store_dir / 'meta.json').open('w'))
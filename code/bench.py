@@ -0,0 +1,300 @@
+"""
+Benchmarks of the data and model paths
+Run from the root directory, for example:
+python code/bench.py jpeg_draft --ds_to_use='refclef'
+Any argument of configs/cfg.json can be changed the same way
+as in main_dist.py
+"""
+import json
+import pickle
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+
+import dat_loader
+from anchors import get_ratios_scales
+from dat_loader import (ImgQuDataset, QlenBucketBatchSampler, collater,
+                        get_dataloader, padded_tokens)
+from extended_config import cfg as conf, key_maps, update_from_dict
+from img_store import load_resized
+from mdl import get_default_net, inference_mode
+from synth_data import synth_data
+from utils import batch_to_device
+
+
+def get_cfg(kwargs):
+    return update_from_dict(conf, kwargs, key_maps)
+
+
+def get_model(cfg):
+    "Same model as learner_init in main_dist.py, in eval mode"
+    ratios, scales = get_ratios_scales(cfg)
+    mdl = get_default_net(num_anchors=len(ratios) * len(scales), cfg=cfg)
+    return mdl.to(torch.device(cfg.device)).eval()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def get_dataset(cfg, split='trn_csv_file'):
+    ds_name = cfg.ds_to_use
+    return ImgQuDataset(cfg=cfg, csv_file=cfg.ds_info[ds_name][split],
+                        ds_name=ds_name, split_type=split)
+
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255 ** 2 / mse)
+
+
+def jpeg_draft(num_imgs=200, **kwargs):
+    """
+    Full decode + resize vs JPEG draft decode + resize
+    of the first `num_imgs` images of the train split.
+    Reports the time per image and how close the draft images are
+    """
+    cfg = get_cfg(kwargs)
+    ds = get_dataset(cfg)
+    img_files = [ds.img_dir / i for i in
+                 list(dict.fromkeys(ds.get_img_ids()))[:num_imgs]]
+    size = cfg.resize_img
+
+    out = {}
+    for draft in [False, True]:
+        imgs = []
+        st = time.perf_counter()
+        for img_file in img_files:
+            imgs.append(load_resized(img_file, size, draft=draft))
+        out[draft] = (time.perf_counter() - st) / len(img_files), imgs
+
+    (full_t, full_imgs), (draft_t, draft_imgs) = out[False], out[True]
+    assert all(f[1:] == d[1:] for f, d in zip(full_imgs, draft_imgs))
+    diffs = [np.abs(f[0].astype(np.int16) - d[0]).mean()
+             for f, d in zip(full_imgs, draft_imgs)]
+    psnrs = [psnr(f[0], d[0]) for f, d in zip(full_imgs, draft_imgs)]
+    print(f'images: {len(img_files)}, size: {size}')
+    print(f'full decode: {full_t * 1000:.2f} ms/img')
+    print(f'draft decode: {draft_t * 1000:.2f} ms/img '
+          f'({full_t / draft_t:.2f}x)')
+    print(f'mean abs diff: {np.mean(diffs):.3f}, '
+          f'median psnr: {np.median(psnrs):.2f} dB')
+
+
+def qlen_bucket(num_batches=100, **kwargs):
+    """
+    Padded tokens per epoch with random batches vs
+    QlenBucketBatchSampler on the train split, and
+    the time of the language encoder on `num_batches` of each
+    """
+    cfg = get_cfg(kwargs)
+    ds = get_dataset(cfg)
+    qlens = ds.get_qlens()
+    bs = cfg.bs
+
+    perm = np.random.RandomState(0).permutation(len(qlens)).tolist()
+    random_batches = [perm[i: i + bs] for i in range(0, len(perm), bs)]
+    bucket_batches = list(QlenBucketBatchSampler(
+        qlens, bs, bucket_mult=cfg.bucket_mult))
+
+    device = torch.device(cfg.device)
+    mdl = get_model(cfg)
+    for name, batches in [('random', random_batches),
+                          ('bucketed', bucket_batches)]:
+        padded, actual = padded_tokens(batches, qlens)
+        tot_time = 0
+        with torch.no_grad():
+            for b in batches[:num_batches]:
+                b_qlens = torch.from_numpy(qlens[b]).long()
+                max_qlen = int(b_qlens.max())
+                word_embs = torch.randn(len(b), max_qlen, cfg.emb_dim,
+                                        device=device)
+                sync(device)
+                st = time.perf_counter()
+                mdl.apply_lstm(word_embs, b_qlens.to(device), max_qlen,
+                               qlens_cpu=b_qlens)
+                sync(device)
+                tot_time += time.perf_counter() - st
+        print(f'{name}: padded tokens {padded}, actual {actual} '
+              f'({padded / actual:.2f}x), language encoder '
+              f'{tot_time / min(num_batches, len(batches)) * 1000:.2f} '
+              f'ms/batch')
+
+
+def use_synthetic(cfg, out_dir, **synth_kwargs):
+    "Points cfg at a synthetic dataset written in `out_dir`"
+    synth_data(out_dir, **synth_kwargs)
+    cfg.ds_to_use = 'synthetic'
+    ds_info = cfg.ds_info['synthetic']
+    ds_info['data_dir'] = str(out_dir)
+    ds_info['img_dir'] = str(Path(out_dir) / 'images')
+    for k, name in [('trn_csv_file', 'train_flat'), ('val_csv_file', 'val'),
+                    ('test_csv_file', 'test')]:
+        ds_info[k] = str(Path(out_dir) / 'csv_dir' / f'{name}.csv')
+
+
+class StageTimer:
+    "Wraps functions to record the time of every call"
+
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            st = time.perf_counter()
+            out = fn(*args, **kwargs)
+            self.times[name].append(time.perf_counter() - st)
+            return out
+        return timed
+
+    def stats(self):
+        return {k: {'mean_ms': float(np.mean(v) * 1000),
+                    'p95_ms': float(np.percentile(v, 95) * 1000),
+                    'calls': len(v)}
+                for k, v in self.times.items()}
+
+
+def batch_nbytes(batch) -> int:
+    "Bytes sent from a worker to the main process for the batch"
+    return sum(v.numel() * v.element_size() if torch.is_tensor(v)
+               else len(pickle.dumps(v)) for v in batch.values())
+
+
+def stage_times(ds, num_samples, bs):
+    """
+    Per-stage latency of ImgQuDataset items in the main process.
+    make_item includes the query and attention stages
+    """
+    timer = StageTimer()
+    for name in ['load_annotations', 'load_img', 'get_qvec', 'make_item']:
+        setattr(ds, name, timer.wrap(name, getattr(ds, name)))
+    if ds.tok_store is not None:
+        ds.tok_store.get = timer.wrap('tok_ids', ds.tok_store.get)
+    att_fn = dat_loader.create_att_targets
+    dat_loader.create_att_targets = timer.wrap('att_targets', att_fn)
+    timed_collater = timer.wrap('collater', collater)
+    item_fn = timer.wrap('item', ds.__getitem__)
+    try:
+        inds = np.random.RandomState(0).permutation(len(ds))[:num_samples]
+        for st in range(0, len(inds), bs):
+            timed_collater([item_fn(int(i)) for i in inds[st: st + bs]])
+    finally:
+        dat_loader.create_att_targets = att_fn
+    return timer.stats()
+
+
+def loader_throughput(cfg, ds, nw, bs, num_batches):
+    "samples/s and bytes per batch of get_dataloader"
+    cfg.nw, cfg.bs, cfg.num_gpus, cfg.do_dist = nw, bs, 1, False
+    dl = get_dataloader(cfg, ds, is_train=True)
+    it = iter(dl)
+    # Not counting the worker start up
+    next(it)
+    num_samples, nbytes = 0, []
+    st = time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        num_samples += len(batch['idxs'])
+        nbytes.append(batch_nbytes(batch))
+    tot_time = time.perf_counter() - st
+    del it
+    out = {'nw': nw, 'bs': bs, 'samples_per_s': num_samples / tot_time,
+           'bytes_per_batch': float(np.mean(nbytes)) if nbytes else 0.}
+    if ds.img_cache is not None:
+        out['img_cache'] = ds.img_cache.stats()
+    return out
+
+
+def data_pipeline(synthetic=False, num_samples=256, num_batches=20,
+                  nws=(0, 2, 4), bss=(8, 32), out_file=None, **kwargs):
+    """
+    Throughput of the data path on the train split:
+    mean/p95 latency of each stage of ImgQuDataset and collater,
+    samples/s and bytes per batch of get_dataloader for every nw, bs.
+    synthetic: use a small dataset from synth_data.py
+    instead of cfg.ds_to_use
+    Prints the results as json, also written to `out_file` if given
+    """
+    cfg = get_cfg(kwargs)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if synthetic:
+            use_synthetic(cfg, tmp_dir, num_imgs=80)
+        out = {
+            'ds_to_use': cfg.ds_to_use, 'synthetic': synthetic,
+            'resize_img': list(cfg.resize_img),
+            'stages': stage_times(get_dataset(cfg), num_samples, bss[0]),
+            'loader': [loader_throughput(cfg, get_dataset(cfg), nw, bs,
+                                         num_batches)
+                       for nw in nws for bs in bss],
+        }
+    out_txt = json.dumps(out, indent=2)
+    print(out_txt)
+    if out_file is not None:
+        Path(out_file).write_text(out_txt)
+
+
+def random_batch(cfg, bs, max_qlen, device):
+    "Batch of random images and query embeddings, as given by the collater"
+    w, h = cfg.resize_img
+    qlens = torch.randint(1, max_qlen + 1, (bs,))
+    qlens[0] = max_qlen
+    items = [{
+        'img': torch.randint(0, 256, (3, h, w), dtype=torch.uint8),
+        'qvec': torch.randn(max_qlen, cfg.emb_dim),
+        'qlens': qlen,
+    } for qlen in qlens]
+    return batch_to_device(collater(items), device)
+
+
+def time_forward(mdl, batch, num_iters, warmup, device):
+    "ms per forward pass"
+    for _ in range(warmup):
+        mdl(batch)
+    sync(device)
+    st = time.perf_counter()
+    for _ in range(num_iters):
+        mdl(batch)
+    sync(device)
+    return (time.perf_counter() - st) / num_iters * 1000
+
+
+def infer_latency(bs=16, max_qlen=8, num_iters=50, warmup=5, **kwargs):
+    """
+    Latency of ZSGNet.forward in eval mode under no_grad (as in validate)
+    against ZSGNet.inference() under inference_mode
+    """
+    cfg = get_cfg(kwargs)
+    device = torch.device(cfg.device)
+    mdl = get_model(cfg)
+    batch = random_batch(cfg, bs, max_qlen, device)
+
+    with torch.no_grad():
+        eval_ms = time_forward(mdl, batch, num_iters, warmup, device)
+    mdl.inference()
+    with inference_mode():
+        infer_ms = time_forward(mdl, batch, num_iters, warmup, device)
+        out = mdl(batch)
+    print(f'bs {bs}, resize_img {list(cfg.resize_img)}, {device}')
+    print(f'eval: {eval_ms:.2f} ms/batch')
+    print(f'inference: {infer_ms:.2f} ms/batch ({eval_ms / infer_ms:.2f}x), '
+          f'outputs {sorted(out)}')
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'jpeg_draft': jpeg_draft,
+        'qlen_bucket': qlen_bucket,
+        'data_pipeline': data_pipeline,
+        'infer_latency': infer_latency,
+    })
@@ -1,65 +1,124 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+    HAS_ITERABLE_DS = True
+except ImportError:
+    # torch < 1.2, the shards (use_shards) can't be streamed
+    HAS_ITERABLE_DS = False
+
+    class IterableDataset(Dataset):
+        pass
+    get_worker_info = None
 from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import functional as F
 import pandas as pd
-from utils import DataWrap
+from utils import DataWrap, get_rank, get_world_size
 import numpy as np
 from pathlib import Path
 import torch
 from tqdm import tqdm
 import re
 import PIL
+import io
 import json
+import random
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Union, Any, Callable, Tuple
 import pickle
 import ast
 import logging
 from torchvision import transforms
-import spacy
-import cv2
 from extended_config import cfg as conf
+from anchors import (create_att_targets, create_anchors, get_ratios_scales,
+                     get_feat_sizes, assign_anchor_targets)
+from phrase_cache import PhraseEmbCache
+from tok_store import TokenStore
+from img_store import ImageStore, load_resized
+from ann_store import AnnotationStore
+from shard_store import (ShardIndex, part_range, read_ahead, read_shard_rows,
+                         shuffle_buffer)
+from feat_store import FeatureStore
+from functools import partial
 
 
 
-nlp = spacy.load('en_core_web_md')
+_nlp = None
 
-def generate_iou_groundtruth(grid_shapes,true_anchor,true_wh):
+
+def get_nlp():
+    """
+    Loads spacy on first use. Not needed
+    when the queries are tokenized offline
+    """
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load('en_core_web_md')
+    return _nlp
+
+
+def normalize_query(query: str) -> str:
+    "Query text as used for the embeddings"
+    if '_' in query:
+        query = query.replace('_', ' ')
+    return query.strip()
+
+
+def compute_qvec(query: str, phrase_len: int):
     """
-    :param grid_shapes:   widths and heights for generation (w,h)
-    :param true_anchor:  anchor's x and y (x,y)
-    :param true_wh:  anchor's width and height (w,h) use for calculate iou
-    :return: general iou distribution without any hyperparameter for attention loss
+    Word vectors of the `query` padded to `phrase_len` using spacy
+    Returns length of the query and phrase_len x emb_dim vectors
     """
-    def cal_single_iou(box1, box2):
-        smooth = 1e-7
-        xi1 = max(box1[0], box2[0])
-        yi1 = max(box1[1], box2[1])
-        xi2 = min(box1[2], box2[2])
-        yi2 = min(box1[3], box2[3])
-        inter_area = max((yi2 - yi1), 0.) * max((xi2 - xi1), 0.)
+    nlp = get_nlp()
+    qtmp = nlp(str(query))
+    if len(qtmp) == 0:
+        # logger.error('Empty string provided')
+        raise NotImplementedError
+    qlen = len(qtmp)
+    query = query + ' PD'*(phrase_len - qlen)
+    q_chosen_emb = nlp(query)
+    if not len(q_chosen_emb) == phrase_len:
+        q_chosen_emb = q_chosen_emb[:phrase_len]
+
+    q_chosen_emb_vecs = np.array([q.vector for q in q_chosen_emb])
+    return qlen, q_chosen_emb_vecs
+
+
+def get_csv_files(cfg, ds_name: str) -> Dict[str, str]:
+    "All the annotation csv files of the dataset"
+    return {k: v for k, v in cfg.ds_info[ds_name].items()
+            if 'csv_file' in k}
+
+
+def get_phrase_cache_dir(cfg, ds_name: str) -> Path:
+    return Path(cfg.ds_info[ds_name]['data_dir']) / 'phrase_cache'
+
+
+def get_tok_store_dir(cfg, ds_name: str) -> Path:
+    return Path(cfg.ds_info[ds_name]['data_dir']) / 'tok_store' / ds_name
+
 
-        box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-        box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-        union_area = box1_area + box2_area - inter_area
+def get_ann_store_dir(cfg, ds_name: str, csv_file: str) -> Path:
+    return (Path(cfg.ds_info[ds_name]['data_dir']) / 'ann_store' /
+            ds_name / Path(csv_file).stem)
 
-        iou = (inter_area + smooth) / (union_area + smooth)
-        return iou
-    IMAGE_WIDTH = grid_shapes[0]
-    IMAGE_HEIGHT = grid_shapes[1]
 
+def get_img_store_dir(cfg, ds_name: str, csv_file: str) -> Path:
+    w, h = cfg.resize_img
+    return (Path(cfg.ds_info[ds_name]['data_dir']) / 'img_store' /
+            ds_name / f'{w}x{h}' / Path(csv_file).stem)
 
-    t_w,t_h=true_wh
-    t_x,t_y=true_anchor
 
-    gt_box=[t_x-t_w/2,t_y-t_h/2,t_x+t_w/2,t_y+t_h/2]
+def get_feat_store_dir(cfg, ds_name: str, csv_file: str) -> Path:
+    w, h = cfg.resize_img
+    return (Path(cfg.ds_info[ds_name]['data_dir']) / 'feat_store' /
+            ds_name / cfg.mdl_to_use / f'{w}x{h}' / Path(csv_file).stem)
 
-    iou_map=np.zeros([IMAGE_WIDTH,IMAGE_HEIGHT])
-    for i in range(IMAGE_WIDTH):
-        for j in range(IMAGE_HEIGHT):
-            iou_map[i,j]=cal_single_iou(gt_box,[max(i-t_w/2,0.),max(j-t_h/2,0.),min(i+t_w/2,IMAGE_WIDTH),min(j+t_h/2,IMAGE_HEIGHT)])
 
-    return iou_map
+def get_shard_dir(cfg, ds_name: str, csv_file: str) -> Path:
+    return (Path(cfg.ds_info[ds_name]['data_dir']) / 'shards' /
+            ds_name / Path(csv_file).stem)
+
 def pil2tensor(image, dtype: np.dtype):
     "Convert PIL style `image` array to torch style image tensor."
     a = np.asarray(image)
@@ -67,7 +126,7 @@ def pil2tensor(image, dtype: np.dtype):
         a = np.expand_dims(a, 2)
     a = np.transpose(a, (1, 0, 2))
     a = np.transpose(a, (2, 1, 0))
-    return torch.from_numpy(a.astype(dtype, copy=False))
+    return torch.from_numpy(np.ascontiguousarray(a, dtype=dtype))
 
 
 class NewDistributedSampler(DistributedSampler):
@@ -80,6 +139,19 @@ class NewDistributedSampler(DistributedSampler):
     def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True):
         super().__init__(dataset, num_replicas=num_replicas, rank=rank)
         self.shuffle = shuffle
+        # Index in the epoch to start from, when resuming
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start = 0
+
+    def set_start(self, start):
+        "Skips the first `start` indices of the current epoch"
+        self.start = start
+
+    def __len__(self):
+        return self.num_samples - self.start
 
     def __iter__(self):
         if self.shuffle:
@@ -99,7 +171,187 @@ class NewDistributedSampler(DistributedSampler):
         indices = indices[offset: offset + self.num_samples]
         assert len(indices) == self.num_samples
 
-        return iter(indices)
+        return iter(indices[self.start:])
+
+
+class EpochBatchSampler(Sampler):
+    """
+    Base of the batch samplers which yield lists of indices.
+    The batches are shuffled with the epoch as seed,
+    so all replicas agree on them and each takes every
+    num_replicas-th batch, as NewDistributedSampler does for indices
+    """
+
+    def __init__(self, batch_size, shuffle=True, drop_last=False,
+                 num_replicas=1, rank=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # Batch in the epoch to start from, when resuming
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        "Skips the first `start` batches of the current epoch"
+        self.start = start
+
+    def get_generator(self):
+        g = torch.Generator()
+        g.manual_seed(self.epoch)
+        return g
+
+    def get_batches(self) -> List[List[int]]:
+        "All batches of the epoch, before splitting across replicas"
+        raise NotImplementedError
+
+    def num_batches(self):
+        raise NotImplementedError
+
+    def to_batches(self, inds):
+        batches = [inds[i: i + self.batch_size]
+                   for i in range(0, len(inds), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def num_batches_per_replica(self):
+        # Same for every replica, see __iter__
+        return -(-self.num_batches() // self.num_replicas)
+
+    def __len__(self):
+        return self.num_batches_per_replica() - self.start
+
+    def __iter__(self):
+        batches = self.get_batches()
+        # add extra batches to make it evenly divisible
+        total = self.num_batches_per_replica() * self.num_replicas
+        batches += batches[: total - len(batches)]
+        return iter(batches[self.rank: total: self.num_replicas][self.start:])
+
+
+class ImgGroupedBatchSampler(EpochBatchSampler):
+    """
+    Batch sampler which keeps the queries of an image together,
+    so that the image is loaded only once per batch.
+    The rows of an image are split in groups of at most
+    `max_q_per_img`, the groups are shuffled every epoch
+    and packed into batches.
+    Yields lists of indices, the dataset loads them as a whole
+    (see WholeBatchSampler)
+    """
+
+    def __init__(self, img_inds, batch_size, max_q_per_img=4, **kwargs):
+        super().__init__(batch_size, **kwargs)
+        self.img_inds = np.asarray(img_inds)
+        self.max_q_per_img = max_q_per_img
+
+        # Rows of every image
+        order = np.argsort(self.img_inds, kind='stable')
+        splits = np.flatnonzero(np.diff(self.img_inds[order])) + 1
+        self.img_rows = np.split(order, splits)
+
+    def get_batches(self):
+        g = self.get_generator()
+        groups = []
+        for rows in self.img_rows:
+            if self.shuffle:
+                rows = rows[torch.randperm(len(rows), generator=g).numpy()]
+            groups += [rows[i: i + self.max_q_per_img]
+                       for i in range(0, len(rows), self.max_q_per_img)]
+        if self.shuffle:
+            groups = [groups[i] for i in
+                      torch.randperm(len(groups), generator=g).tolist()]
+        return self.to_batches(np.concatenate(groups).tolist())
+
+    def num_batches(self):
+        num = len(self.img_inds) // self.batch_size
+        if not self.drop_last and len(self.img_inds) % self.batch_size:
+            num += 1
+        return num
+
+
+class WholeBatchSampler(Sampler):
+    """
+    Yields every batch of `batch_sampler` as a batch of a single
+    index, the list of indices, which the dataset loads at once
+    (ImgQuDataset.get_batch). Used with collate_whole_batch:
+    the DataLoader of torch < 1.2 has no batch_size=None
+    """
+
+    def __init__(self, batch_sampler: EpochBatchSampler):
+        self.batch_sampler = batch_sampler
+
+    def set_epoch(self, epoch):
+        self.batch_sampler.set_epoch(epoch)
+
+    def set_start(self, start):
+        self.batch_sampler.set_start(start)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        return ([batch] for batch in self.batch_sampler)
+
+
+class QlenBucketBatchSampler(EpochBatchSampler):
+    """
+    Batches of queries with similar lengths, to reduce padding
+    in the language encoder.
+    The shuffled indices are split in buckets of
+    `bucket_mult` batches, sorted by qlen inside a bucket
+    and cut into batches. The batches are shuffled again.
+    """
+
+    def __init__(self, qlens, batch_size, bucket_mult=50, **kwargs):
+        super().__init__(batch_size, **kwargs)
+        self.qlens = np.asarray(qlens)
+        self.bucket_mult = bucket_mult
+
+    def get_batches(self):
+        g = self.get_generator()
+        if self.shuffle:
+            inds = torch.randperm(len(self.qlens), generator=g).numpy()
+        else:
+            inds = np.arange(len(self.qlens))
+        bucket_size = self.batch_size * self.bucket_mult
+        batches = []
+        for st in range(0, len(inds), bucket_size):
+            bucket = inds[st: st + bucket_size]
+            bucket = bucket[np.argsort(self.qlens[bucket], kind='stable')]
+            batches += [bucket[i: i + self.batch_size].tolist()
+                        for i in range(0, len(bucket), self.batch_size)]
+        if self.drop_last:
+            # Only the last bucket can have a smaller batch
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in
+                       torch.randperm(len(batches), generator=g).tolist()]
+        return batches
+
+    def num_batches(self):
+        num = len(self.qlens) // self.batch_size
+        if not self.drop_last and len(self.qlens) % self.batch_size:
+            num += 1
+        return num
+
+
+def padded_tokens(batches: List[List[int]], qlens: np.ndarray):
+    """
+    Number of tokens fed to the language encoder
+    after padding each batch to its longest query,
+    and the number of actual tokens
+    """
+    qlens = np.asarray(qlens)
+    padded = sum(len(b) * qlens[b].max() for b in batches)
+    actual = sum(qlens[b].sum() for b in batches)
+    return int(padded), int(actual)
 
 
 class ImgQuDataset(Dataset):
@@ -117,45 +369,145 @@ class ImgQuDataset(Dataset):
         self.ds_name = ds_name
         self.split_type = split_type
 
-        # self.image_data = pd.read_csv(csv_file)
-        self.image_data = self._read_annotations(csv_file)
+        self.init_annotations(csv_file)
         # self.image_data = self.image_data.iloc[:200]
         self.img_dir = Path(self.cfg.ds_info[self.ds_name]['img_dir'])
         self.phrase_len = 50
+        if self.cfg['use_tok_ids']:
+            self.tok_store = TokenStore(
+                get_tok_store_dir(self.cfg, self.ds_name),
+                Path(self.ann_file).stem)
+            assert len(self.tok_store) == self.num_rows()
+        else:
+            self.tok_store = None
+            # Load spacy before the workers are forked
+            get_nlp()
+        if self.cfg['use_img_store']:
+            self.img_store = ImageStore(get_img_store_dir(
+                self.cfg, self.ds_name, self.ann_file))
+            assert self.img_store.size == list(self.cfg.resize_img)
+        else:
+            self.img_store = None
+        if self.cfg['use_feat_store']:
+            # Encoder outputs instead of images (see feat_store.py)
+            self.feat_store = FeatureStore(get_feat_store_dir(
+                self.cfg, self.ds_name, self.ann_file))
+        else:
+            self.feat_store = None
+        if self.cfg['shm_cache_mb'] > 0 and self.img_store is None:
+            # Shared by the workers, so created before they start.
+            # shared_memory needs python 3.8+, only imported when used
+            from shm_cache import SharedImageCache
+            w, h = self.cfg.resize_img
+            self.img_cache = SharedImageCache(
+                self.cfg['shm_cache_mb'], (h, w, 3))
+        else:
+            self.img_cache = None
+        if self.cfg['use_phrase_cache']:
+            self.phrase_cache = PhraseEmbCache(
+                get_phrase_cache_dir(self.cfg, self.ds_name),
+                partial(compute_qvec, phrase_len=self.phrase_len),
+                lru_size=self.cfg['phrase_cache_lru'])
+        else:
+            self.phrase_cache = None
+        if self.cfg['anchor_tgt_in_loader']:
+            # Same anchors as the loss, the feature sizes
+            # only depend on the input size
+            ratios, scales = get_ratios_scales(self.cfg)
+            self.anchs = create_anchors(
+                get_feat_sizes(self.cfg.resize_img, self.cfg.mdl_to_use),
+                ratios, scales, flatten=True, device=torch.device('cpu'))
+        else:
+            self.anchs = None
         self.item_getter = getattr(self, 'simple_item_getter')
         # normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
         # std=[0.229, 0.224, 0.225])
 
-    def __len__(self):
+    def init_annotations(self, csv_file):
+        # self.image_data = pd.read_csv(csv_file)
+        if self.cfg['use_ann_store']:
+            # Converted offline from the csv file (see ann_store.py)
+            self.ann_store = AnnotationStore(
+                get_ann_store_dir(self.cfg, self.ds_name, csv_file))
+            self.image_data = None
+        else:
+            self.ann_store = None
+            self.image_data = self._read_annotations(csv_file)
+
+    def num_rows(self):
+        "Rows of the annotations"
+        if self.ann_store is not None:
+            return len(self.ann_store)
         return len(self.image_data)
 
+    def __len__(self):
+        return self.num_rows()
+
     def __getitem__(self, idx):
+        if isinstance(idx, list):
+            # Whole batch from ImgGroupedBatchSampler
+            return self.get_batch(idx)
         return self.item_getter(idx)
 
-    def simple_item_getter(self, idx):
-        img_file, annot, q_chosen = self.load_annotations(idx)
-        img = PIL.Image.open(img_file).convert('RGB')
-        img_ = np.array(img)
-        h, w = img.height, img.width
+    def get_batch(self, idxs):
+        """
+        Items of all the idxs, each image is loaded once.
+        img_inds maps every item to its image in the batch
+        """
+        imgs = {}
+        out = []
+        for idx in idxs:
+            item = self.item_getter(idx, imgs)
+            item['img_inds'] = torch.tensor(
+                list(imgs).index(item['img_id'])).long()
+            del item['img_id']
+            out.append(item)
+        return out
 
+    def simple_item_getter(self, idx, imgs=None):
+        """
+        imgs: Optional dict of images already loaded,
+        img_id -> output of load_img
+        """
+        img_id, annot, q_chosen, qind = self.load_annotations(idx)
+        if self.feat_store is not None:
+            # The image itself is not needed
+            img = None
+            h, w = self.feat_store.get_hw(img_id)
+            if imgs is not None:
+                # Still indexes the images of the batch
+                imgs.setdefault(img_id, None)
+        elif imgs is None:
+            img, h, w = self.load_img(img_id)
+        else:
+            if img_id not in imgs:
+                imgs[img_id] = self.load_img(img_id)
+            img, h, w = imgs[img_id]
+
+        out = self.make_item(idx, annot, q_chosen, qind, img, h, w)
+        if self.feat_store is not None:
+            for l, feat in enumerate(self.feat_store.get(img_id)):
+                out[f'img_feat_{l}'] = torch.from_numpy(feat)
+        if imgs is not None:
+            out['img_id'] = img_id
+        return out
+
+    def make_item(self, idx, annot, q_chosen, qind, img, h, w):
+        """
+        Model inputs and targets for row idx given
+        its parsed annotations and loaded image
+        """
         q_chosen = q_chosen.strip()
         sents = q_chosen
-        qtmp = nlp(str(q_chosen))
-        if len(qtmp) == 0:
-            # logger.error('Empty string provided')
-            raise NotImplementedError
-        qlen = len(qtmp)
-        q_chosen = q_chosen + ' PD'*(self.phrase_len - qlen)
-        q_chosen_emb = nlp(q_chosen)
-        if not len(q_chosen_emb) == self.phrase_len:
-            q_chosen_emb = q_chosen_emb[:self.phrase_len]
-
-        q_chosen_emb_vecs = np.array([q.vector for q in q_chosen_emb])
+        if self.tok_store is not None:
+            qlen, qids = self.tok_store.get(idx, qind)
+            if qlen == 0:
+                raise NotImplementedError
+        else:
+            qlen, q_chosen_emb_vecs = self.get_qvec(q_chosen)
         # qlen = len(q_chosen_emb_vecs)
         # Annot is in x1y1x2y2 format
         target = np.array(annot)
-        # img = self.resize_fixed_transform(img)
-        img = img.resize((self.cfg.resize_img[0], self.cfg.resize_img[1]))
         # Now target is in y1x1y2x2 format which is required by the model
         # The above is because the anchor format is created
         # in row, column format
@@ -166,62 +518,138 @@ class ImgQuDataset(Dataset):
             target[2] / h, target[3] / w
         ])
 
-        if self.cfg['use_att_loss']:
-            rstarget=target*self.cfg.resize_img[0]
-            iou_annot_stage_0=generate_iou_groundtruth([self.cfg.resize_img[0]//8,self.cfg.resize_img[0]//8],
-                                                       [(rstarget[0]+rstarget[2])/16,(rstarget[1]+rstarget[3])/16],
-                                                       [(rstarget[2]-rstarget[0])/16,(rstarget[3]-rstarget[1])/16])
-            iou_annot_stage_1=cv2.resize(iou_annot_stage_0,(self.cfg.resize_img[0]//16, self.cfg.resize_img[1]//16))
-            iou_annot_stage_2 = cv2.resize(iou_annot_stage_0, (self.cfg.resize_img[0] // 32, self.cfg.resize_img[1] // 32))
-            # cv2.imwrite('./samples/' + str(idx) + '_0.jpg', iou_annot_stage_0*255)
-            # cv2.imwrite('./samples/' + str(idx) + '_1.jpg', iou_annot_stage_1*255)
-            # cv2.imwrite('./samples/' + str(idx) + '_2.jpg', iou_annot_stage_2*255)
-            #
-            # # cv2.circle(gttttt, tuple(annot[:2]), 2, 255)
-            # # cv2.circle(gttttt, tuple(annot[2:]), 2, 255)
-            # cv2.rectangle(img_,tuple(annot[:2]), tuple(annot[2:]),255,10)
-            # cv2.imwrite('./samples/' + str(idx) + '_gt.jpg', img_)
-        else:
-            iou_annot_stage_0 = np.zeros([1])
-            iou_annot_stage_1 = np.zeros([1])
-            iou_annot_stage_2 = np.zeros([1])
+        rstarget = target * self.cfg.resize_img[0]
         # Target in range -1 to 1
         target = 2 * target - 1
 
+        if self.cfg['use_att_loss'] and not self.cfg['att_tgt_on_device']:
+            iou_annot_stage_0, iou_annot_stage_1, iou_annot_stage_2 = [
+                iou_map[0] for iou_map in create_att_targets(
+                    torch.from_numpy(target).float()[None],
+                    self.cfg.resize_img)]
+        else:
+            # Either not needed or created by the loss function
+            iou_annot_stage_0 = torch.zeros([1])
+            iou_annot_stage_1 = torch.zeros([1])
+            iou_annot_stage_2 = torch.zeros([1])
+
         # img = self.img_transforms(img)
         # img = Image(pil2tensor(img, np.float_).float().div_(255))
-        img = pil2tensor(img, np.float_).float().div_(255)
-        out = {
-            'img': img,
+        out = {}
+        if img is not None:
+            # Sent as uint8, converted to float on the device (see ZSGNet)
+            out['img'] = pil2tensor(img, np.uint8)
+        out.update({
             'idxs': torch.tensor(idx).long(),
-            'qvec': torch.from_numpy(q_chosen_emb_vecs),
-            'qlens': torch.tensor(qlen),
+            'qlens': torch.tensor(qlen).long(),
             'annot': torch.from_numpy(target).float(),
             'bboxs': torch.from_numpy(rstarget).float(),
             'orig_annot': torch.tensor(annot).float(),
-            'img_size': torch.tensor([h, w]),
+            'img_size': torch.tensor([h, w]).long(),
             'sents': sents,
-            'iou_annot_stage_0':torch.tensor(iou_annot_stage_0).float(),
-            'iou_annot_stage_1': torch.tensor(iou_annot_stage_1).float(),
-            'iou_annot_stage_2': torch.tensor(iou_annot_stage_2).float()
-        }
-
+            'iou_annot_stage_0': iou_annot_stage_0,
+            'iou_annot_stage_1': iou_annot_stage_1,
+            'iou_annot_stage_2': iou_annot_stage_2
+        })
+        if self.tok_store is not None:
+            out['qids'] = torch.from_numpy(qids)
+        else:
+            out['qvec'] = torch.from_numpy(q_chosen_emb_vecs)
+        if self.anchs is not None:
+            out['pos_inds'], out['best_ind'] = assign_anchor_targets(
+                self.anchs, out['annot'], self.cfg['matching_threshold'])
         return out
 
+    def load_img(self, img_id):
+        """
+        Image resized to cfg.resize_img as H x W x 3 uint8 array
+        and the original height, width
+        """
+        if self.img_store is not None:
+            return self.img_store.get(img_id)
+        if self.img_cache is not None:
+            w, h = self.cfg.resize_img
+            img_key = f'{img_id}@{w}x{h}'
+            out = self.img_cache.get(img_key)
+            if out is None:
+                out = load_resized(self.img_dir / img_id, self.cfg.resize_img,
+                                   draft=self.cfg.jpeg_draft)
+                self.img_cache.put(img_key, *out)
+            return out
+        return load_resized(self.img_dir / img_id, self.cfg.resize_img,
+                            draft=self.cfg.jpeg_draft)
+
+    def get_qvec(self, query):
+        "Length and word vectors of the query"
+        if self.phrase_cache is not None:
+            return self.phrase_cache.get(query)
+        return compute_qvec(query, self.phrase_len)
+
+    def get_img_ids(self) -> List[str]:
+        "Image of every row of the csv file"
+        if self.ann_store is not None:
+            return [self.ann_store.img_ids[i] for i in self.ann_store.img_inds]
+        return [f'{i}' for i in self.image_data.iloc[:, 0]]
+
+    def get_img_inds(self) -> np.ndarray:
+        "Interned image of every row"
+        if self.ann_store is not None:
+            return np.array(self.ann_store.img_inds)
+        return pd.factorize(self.image_data.iloc[:, 0])[0]
+
+    def get_qlens(self) -> np.ndarray:
+        """
+        Length of the longest query of every row
+        (capped at phrase_len), for bucketing by length
+        """
+        if self.tok_store is not None:
+            offsets = np.array(self.tok_store.offsets)
+            return np.maximum.reduceat(
+                np.array(self.tok_store.qlens), offsets[:-1])
+        tokenizer = get_nlp().tokenizer
+        return np.array([
+            min(max(len(tokenizer(q)) for q in queries), self.phrase_len)
+            for queries in self.get_row_queries()])
+
+    def get_row_queries(self) -> List[List[str]]:
+        "Queries of every row of the csv file, as used for the embeddings"
+        if self.ann_store is not None:
+            row_queries = [self.ann_store.get_queries(idx)
+                           for idx in range(len(self))]
+        else:
+            row_queries = self.image_data['query']
+        return [[normalize_query(q) for q in qs] if isinstance(qs, list)
+                else [normalize_query(qs)]
+                for qs in row_queries]
+
+    def get_all_queries(self) -> List[str]:
+        "Every query of the csv file, as used for the embeddings"
+        return [q for qs in self.get_row_queries() for q in qs]
+
+    def get_row(self, idx):
+        "img_id, x1, y1, x2, y2, queries of the row"
+        if self.ann_store is not None:
+            return self.ann_store.get_row(idx)
+        return self.image_data.iloc[idx]
+
     def load_annotations(self, idx):
-        annotation_list = self.image_data.iloc[idx]
-        img_file, x1, y1, x2, y2, queries = annotation_list
-        img_file = self.img_dir / f'{img_file}'
+        return self.parse_row(self.get_row(idx))
+
+    def parse_row(self, row):
+        "img_id, annotations, chosen query and its index in the row"
+        img_id, x1, y1, x2, y2, queries = row
+        img_id = f'{img_id}'
         if isinstance(queries, list):
-            query_chosen = np.random.choice(queries)
+            qind = np.random.randint(len(queries))
+            query_chosen = queries[qind]
         else:
             assert isinstance(queries, str)
+            qind = 0
             query_chosen = queries
-        if '_' in query_chosen:
-            query_chosen = query_chosen.replace('_', ' ')
+        query_chosen = normalize_query(query_chosen)
         # annotations = np.array([y1, x1, y2, x2])
         annotations = np.array([x1, y1, x2, y2])
-        return img_file, annotations, query_chosen
+        return img_id, annotations, query_chosen, qind
 
     def _read_annotations(self, trn_file):
         trn_data = pd.read_csv(trn_file)
@@ -252,22 +680,125 @@ class ImgQuDataset(Dataset):
         elif self.ds_name == 'refcoco':
             trn_df = trn_data[['img_id',
                                 'x1', 'y1', 'x2', 'y2', 'query']]
+        elif self.ds_name == 'synthetic':
+            # Written by synth_data.py, same format as refclef
+            trn_df = trn_data[['img_id',
+                               'x1', 'y1', 'x2', 'y2', 'query']]
         else :
             raise RuntimeError("No dataset named {}".format(self.ds_name))
         return trn_df
 
 
+class ImgQuStreamDataset(ImgQuDataset, IterableDataset):
+    """
+    ImgQuDataset read sequentially from tar shards
+    (see shard_store.py and prep_data.py shards).
+    The rows of all the shards, in an order shuffled every epoch,
+    are split in contiguous ranges: one per rank, then one per
+    DataLoader worker. Each worker reads the shards of its range
+    with a read-ahead thread and a shuffle buffer over the samples.
+    For training (shuffle) every rank gets the same number of rows,
+    the last one wraps around to the first rows (as DistributedSampler
+    pads), otherwise the ranks run a different number of steps and
+    hang in the all-reduce. For evaluation every row is read once.
+    A range can start in the middle of a shard, so there should be
+    many more shards than workers x ranks
+    """
+
+    def __init__(self, cfg, csv_file, ds_name, split_type='train',
+                 shuffle=False):
+        if not HAS_ITERABLE_DS:
+            raise NotImplementedError('use_shards needs torch >= 1.2')
+        super().__init__(cfg, csv_file, ds_name, split_type)
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def init_annotations(self, csv_file):
+        self.shard_index = ShardIndex(
+            get_shard_dir(self.cfg, self.ds_name, csv_file))
+        self.ann_store = None
+        self.image_data = None
+
+    def num_rows(self):
+        return len(self.shard_index)
+
+    def rank_range(self) -> Tuple[int, int]:
+        "Rows of this rank"
+        total, rank, world_size = self.num_rows(), get_rank(), get_world_size()
+        if self.shuffle:
+            num = -(-total // world_size)
+            return rank * num, (rank + 1) * num
+        return part_range(total, rank, world_size)
+
+    def __len__(self):
+        "Samples of this rank"
+        start, stop = self.rank_range()
+        return stop - start
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_reader(self) -> Tuple[int, int, int, int]:
+        """
+        Rows start, stop of this worker of this rank,
+        its reader number and the number of readers
+        """
+        worker_info = get_worker_info()
+        wid, nw = ((worker_info.id, worker_info.num_workers)
+                   if worker_info is not None else (0, 1))
+        rank_start, rank_stop = self.rank_range()
+        start, stop = part_range(rank_stop - rank_start, wid, nw)
+        return (rank_start + start, rank_start + stop,
+                get_rank() * nw + wid, get_world_size() * nw)
+
+    def iter_samples(self, start: int, stop: int):
+        "Samples of the rows start..stop"
+        ranges = self.shard_index.row_ranges(
+            start, stop, shuffle=self.shuffle, seed=self.epoch)
+        for img_id, img_bytes, rows in read_ahead(
+                ranges, self.cfg.shard_read_ahead,
+                read_fn=lambda rng: read_shard_rows(*rng)):
+            img, h, w = load_resized(io.BytesIO(img_bytes),
+                                     self.cfg.resize_img,
+                                     draft=self.cfg.jpeg_draft)
+            for idx, *row in rows:
+                _, annot, q_chosen, qind = self.parse_row([img_id, *row])
+                yield self.make_item(idx, annot, q_chosen, qind, img, h, w)
+
+    def __iter__(self):
+        start, stop, part, num_parts = self.get_reader()
+        samples = self.iter_samples(start, stop)
+        if self.shuffle:
+            # Different stream for every reader
+            rng = random.Random(self.epoch * num_parts + part)
+            samples = shuffle_buffer(samples, self.cfg.shuffle_buffer, rng)
+        return samples
+
+
+def collate_whole_batch(batch):
+    "collater of the items of the single batch from WholeBatchSampler"
+    return collater(batch[0])
+
+
 def collater(batch):
     qlens = torch.Tensor([i['qlens'] for i in batch])
     max_qlen = int(qlens.max().item())
     # query_vecs = [torch.Tensor(i['query'][:max_qlen]) for i in batch]
     out_dict = {}
     for k in batch[0]:
-        if k != 'sents':
-            out_dict[k] = torch.stack([b[k] for b in batch]).float()
-        else:
+        if k == 'sents':
             out_dict[k] = [b[k] for b in batch]
-    out_dict['qvec'] = out_dict['qvec'][:, :max_qlen]
+        elif k == 'pos_inds':
+            # Different number of positive anchors, padded with -1
+            out_dict[k] = torch.nn.utils.rnn.pad_sequence(
+                [b[k] for b in batch], batch_first=True, padding_value=-1)
+        else:
+            # Keeps the dtype, images and integer fields are not
+            # converted to float here
+            out_dict[k] = torch.stack([b[k] for b in batch])
+    for k in ['qvec', 'qids']:
+        if k in out_dict:
+            out_dict[k] = out_dict[k][:, :max_qlen]
 
     return out_dict
 
@@ -276,7 +807,9 @@ def make_data_sampler(dataset, shuffle, distributed):
     if distributed:
         return NewDistributedSampler(dataset, shuffle=shuffle)
     if shuffle:
-        sampler = torch.utils.data.sampler.RandomSampler(dataset)
+        # Seeded by the epoch, so an epoch can be resumed midway
+        sampler = NewDistributedSampler(
+            dataset, num_replicas=1, rank=0, shuffle=True)
     else:
         sampler = torch.utils.data.sampler.SequentialSampler(dataset)
     return sampler
@@ -297,42 +830,76 @@ def get_dataloader(cfg, dataset: Dataset, is_train: bool) -> DataLoader:
         shuffle = True
     else:
         shuffle = False if not is_distributed else True
+    # Pinned batches are copied asynchronously by the BatchPrefetcher
+    pin_memory = (cfg.use_prefetcher and
+                  torch.device(cfg.device).type == 'cuda')
+    if isinstance(dataset, IterableDataset):
+        # Shuffling and sharding are done by the dataset
+        return DataLoader(dataset, batch_size=batch_size,
+                          drop_last=is_train, num_workers=num_workers,
+                          collate_fn=collater, pin_memory=pin_memory)
+    if cfg.group_by_img:
+        # The dataset returns whole batches
+        batch_sampler = ImgGroupedBatchSampler(
+            dataset.get_img_inds(), batch_size,
+            max_q_per_img=cfg.max_q_per_img, shuffle=shuffle,
+            drop_last=is_train, num_replicas=get_world_size(),
+            rank=get_rank())
+        return DataLoader(dataset,
+                          batch_sampler=WholeBatchSampler(batch_sampler),
+                          num_workers=num_workers,
+                          collate_fn=collate_whole_batch,
+                          pin_memory=pin_memory)
+    if cfg.bucket_by_qlen:
+        batch_sampler = QlenBucketBatchSampler(
+            dataset.get_qlens(), batch_size, bucket_mult=cfg.bucket_mult,
+            shuffle=shuffle, drop_last=is_train,
+            num_replicas=get_world_size(), rank=get_rank())
+        return DataLoader(dataset, batch_sampler=batch_sampler,
+                          num_workers=num_workers, collate_fn=collater,
+                          pin_memory=pin_memory)
     sampler = make_data_sampler(dataset, shuffle, is_distributed)
     return DataLoader(dataset, batch_size=batch_size,
                       sampler=sampler, drop_last=is_train,
-                      num_workers=num_workers, collate_fn=collater)
+                      num_workers=num_workers, collate_fn=collater,
+                      pin_memory=pin_memory)
 
 
 def get_data(cfg):
     # Get which dataset to use
     ds_name = cfg.ds_to_use
+    if cfg.use_shards:
+        trn_ds_cls = partial(ImgQuStreamDataset, shuffle=True)
+        ds_cls = partial(ImgQuStreamDataset, shuffle=False)
+    else:
+        trn_ds_cls = ds_cls = ImgQuDataset
 
     # Training file
     trn_csv_file = cfg.ds_info[ds_name]['trn_csv_file']
-    trn_ds = ImgQuDataset(cfg=cfg, csv_file=trn_csv_file,
-                          ds_name=ds_name, split_type='train')
+    trn_ds = trn_ds_cls(cfg=cfg, csv_file=trn_csv_file,
+                        ds_name=ds_name, split_type='train')
     trn_dl = get_dataloader(cfg, trn_ds, is_train=True)
 
     # Validation file
     val_csv_file = cfg.ds_info[ds_name]['val_csv_file']
-    val_ds = ImgQuDataset(cfg=cfg, csv_file=val_csv_file,
-                          ds_name=ds_name, split_type='valid')
+    val_ds = ds_cls(cfg=cfg, csv_file=val_csv_file,
+                    ds_name=ds_name, split_type='valid')
     val_dl = get_dataloader(cfg, val_ds, is_train=False)
 
     if ds_name == 'refcoco' or ds_name == 'refcoco+':
         test_csv_filea = cfg.ds_info[ds_name]['test_csv_fileA']
-        test_dsa = ImgQuDataset(cfg=cfg, csv_file=test_csv_filea,
-                            ds_name=ds_name, split_type='valid')
+        test_dsa = ds_cls(cfg=cfg, csv_file=test_csv_filea,
+                          ds_name=ds_name, split_type='valid')
         test_dla = get_dataloader(cfg, test_dsa, is_train=False)
         test_csv_fileb = cfg.ds_info[ds_name]['test_csv_fileB']
-        test_dsb = ImgQuDataset(cfg=cfg, csv_file=test_csv_fileb,
-                            ds_name=ds_name, split_type='valid')
+        test_dsb = ds_cls(cfg=cfg, csv_file=test_csv_fileb,
+                          ds_name=ds_name, split_type='valid')
         test_dlb = get_dataloader(cfg, test_dsb, is_train=False)
         test_dl={'testA': test_dla, 'testB': test_dlb}
     else :
         test_csv_file = cfg.ds_info[ds_name]['test_csv_file']
-        test_ds = ImgQuDataset(cfg=cfg, csv_file=test_csv_file,
-                            ds_name=ds_name, split_type='valid')
+        test_ds = ds_cls(cfg=cfg, csv_file=test_csv_file,
+                         ds_name=ds_name, split_type='valid')
         test_dl = get_dataloader(cfg, test_ds, is_train=False)
         test_dl = {'test0': test_dl}
 
@@ -1,20 +1,44 @@
 import torch
 from torch import nn
-from anchors import (create_anchors, reg_params_to_bbox,
-                     IoU_values, x1y1x2y2_to_y1x1y2x2)
-from typing import Dict
-from functools import partial
+from anchors import (reg_params_to_bbox, IoU_values, x1y1x2y2_to_y1x1y2x2,
+                     get_anchor_grids, input_hw)
+from typing import Dict, Optional
 # from utils import reduce_dict
 
 
-def reshape(box, new_size):
+def to_img_boxes(boxes, img_size):
     """
-    box: (N, 4) in y1x1y2x2 format
-    new_size: (N, 2) stack of (h, w)
+    boxes: B x ... x 4 in r1c1r2c2 format, range -1 to 1
+    img_size: B x 2 stack of (h, w) of the original images
+    Returns the boxes in x1y1x2y2 pixels of the original images
     """
-    box[:, :2] = new_size * box[:, :2]
-    box[:, 2:] = new_size * box[:, 2:]
-    return box
+    hw = img_size.float().view(-1, *[1] * (boxes.dim() - 2), 2)
+    boxes = (boxes + 1) / 2
+    boxes = torch.cat([boxes[..., :2] * hw, boxes[..., 2:] * hw], dim=-1)
+    return x1y1x2y2_to_y1x1y2x2(boxes)
+
+
+def decode_topk(att_out, reg_box, anchs, k=1, extra_inds=None):
+    """
+    Decodes only the k best scoring anchors of every sample
+    instead of all the anchors.
+    att_out: B x num_anchs (x 1) logits, reg_box: B x num_anchs x 4
+    anchs: num_anchs x 4
+    extra_inds: (optional) B x E more anchors to decode (like the gt best)
+    Returns scores (B x k, after sigmoid), their anchor indices (B x k),
+    boxes (B x k x 4) and boxes of extra_inds (B x E x 4 or None),
+    boxes in r1c1r2c2 format, range -1 to 1.
+    k is at most num_anchs
+    """
+    k = min(k, att_out.size(1))
+    logits, inds = att_out.reshape(att_out.size(0), -1).topk(k, dim=1)
+    all_inds = inds
+    if extra_inds is not None:
+        all_inds = torch.cat([inds, extra_inds], dim=1)
+    reg = torch.gather(reg_box, 1, all_inds.unsqueeze(-1).expand(-1, -1, 4))
+    boxes = reg_params_to_bbox(anchs[all_inds], reg)
+    extra_boxes = boxes[:, k:] if extra_inds is not None else None
+    return torch.sigmoid(logits), inds, boxes[:, :k], extra_boxes
 
 
 class Evaluator(nn.Module):
@@ -37,84 +61,75 @@ class Evaluator(nn.Module):
 
         self.lamb_reg = cfg['lamb_reg']
 
-        self.met_keys = ['Acc', 'MaxPos']
-        self.anchs = None
-        self.get_anchors = partial(
-            create_anchors, ratios=self.ratios,
-            scales=self.scales, flatten=True)
+        # MaxPos needs the best anchor of the gt box
+        self.max_pos = cfg['eval_max_pos']
+        self.met_keys = ['Acc', 'MaxPos'] if self.max_pos else ['Acc']
+        # Alternatives returned as topk_boxes, topk_scores if > 1
+        self.topk = cfg['eval_topk']
+        # Anchors of every feature size, shared with the model
+        self.anchor_grids = get_anchor_grids(cfg, ratios, scales)
 
         self.acc_iou_threshold = self.cfg['acc_iou_threshold']
 
     def forward(self, out: Dict[str, torch.tensor],
-                inp: Dict[str, torch.tensor]) -> Dict[str, torch.tensor]:
-
+                inp: Dict[str, torch.tensor],
+                rows: Optional[torch.tensor] = None
+                ) -> Dict[str, torch.tensor]:
+        """
+        rows: (optional) indices of the rows of the batch
+        to evaluate, the others are skipped
+        """
         annot = inp['annot']
         att_box = out['att_out']
         reg_box = out['bbx_out']
-        feat_sizes = out['feat_sizes']
-        num_f_out = out['num_f_out']
-
         device = att_box.device
-
-        if len(num_f_out) > 1:
-            num_f_out = int(num_f_out[0].item())
+        feat_sizes = self.anchor_grids.feat_sizes(
+            input_hw(inp, self.cfg), out)
+        anchs = self.anchor_grids.anchors(feat_sizes, device)
+        if rows is not None:
+            annot, att_box, reg_box = annot[rows], att_box[rows], reg_box[rows]
+            inp = {k: inp[k][rows] for k in ['best_ind', 'idxs', 'img_size']
+                   if k in inp}
+
+        if not self.max_pos:
+            expected_best_ids = None
+        elif 'best_ind' in inp:
+            # Assigned in the data loader (cfg.anchor_tgt_in_loader)
+            expected_best_ids = inp['best_ind']
         else:
-            num_f_out = int(num_f_out.item())
-
-        feat_sizes = feat_sizes[:num_f_out, :]
-
-        if self.anchs is None:
-            feat_sizes = feat_sizes[:num_f_out, :]
-            anchs = self.get_anchors(feat_sizes)
-            anchs = anchs.to(device)
-            self.anchs = anchs
-        else:
-            anchs = self.anchs
-
-        att_box_sigmoid = torch.sigmoid(att_box).squeeze(-1)
-        att_box_best, att_box_best_ids = att_box_sigmoid.max(1)
-        # self.att_box_best = att_box_best
-
-        ious1 = IoU_values(annot, anchs)
-        gt_mask, expected_best_ids = ious1.max(1)
-
-        actual_bbox = reg_params_to_bbox(
-            anchs, reg_box)
-
-        best_possible_result, _ = self.get_eval_result(
-            actual_bbox, annot, expected_best_ids)
+            ious1 = IoU_values(annot, anchs)
+            gt_mask, expected_best_ids = ious1.max(1)
 
-        msk = None
-        actual_result, pred_boxes = self.get_eval_result(
-            actual_bbox, annot, att_box_best_ids, msk)
+        # Only the top anchors (and the best one) are decoded
+        scores, _, boxes, best_boxes = decode_topk(
+            att_box, reg_box, anchs, self.topk,
+            extra_inds=(expected_best_ids.view(-1, 1)
+                        if self.max_pos else None))
+        pred_boxes = boxes[:, 0]
 
         out_dict = {}
-        out_dict['Acc'] = actual_result
-        out_dict['MaxPos'] = best_possible_result
+        out_dict['Acc'] = self.box_acc(pred_boxes, annot)
+        if self.max_pos:
+            out_dict['MaxPos'] = self.box_acc(best_boxes[:, 0], annot)
         out_dict['idxs'] = inp['idxs']
 
-        reshaped_boxes = x1y1x2y2_to_y1x1y2x2(reshape(
-            (pred_boxes + 1)/2, (inp['img_size'])))
-        out_dict['pred_boxes'] = reshaped_boxes
-        out_dict['pred_scores'] = att_box_best
+        out_dict['pred_boxes'] = to_img_boxes(pred_boxes, inp['img_size'])
+        out_dict['pred_scores'] = scores[:, 0]
+        if self.topk > 1:
+            out_dict['topk_boxes'] = to_img_boxes(boxes, inp['img_size'])
+            out_dict['topk_scores'] = scores
         # orig_annot = inp['orig_annot']
         # Sanity check
-        # iou1 = (torch.diag(IoU_values(reshaped_boxes, orig_annot))
+        # iou1 = (torch.diag(IoU_values(out_dict['pred_boxes'], orig_annot))
         #         >= self.acc_iou_threshold).float().mean()
-        # assert actual_result.item() == iou1.item()
+        # assert out_dict['Acc'].item() == iou1.item()
         return out_dict
         # return reduce_dict(out_dict)
 
-    def get_eval_result(self, actual_bbox, annot, ids_to_use, msk=None):
-        best_boxes = torch.gather(
-            actual_bbox, 1, ids_to_use.view(-1, 1, 1).expand(-1, 1, 4))
-        best_boxes = best_boxes.view(best_boxes.size(0), -1)
-        if msk is not None:
-            best_boxes[msk] = 0
-        # self.best_boxes = best_boxes
-        ious = torch.diag(IoU_values(best_boxes, annot))
-        # self.fin_results = ious
-        return (ious >= self.acc_iou_threshold).float().mean(), best_boxes
+    def box_acc(self, boxes, annot):
+        "Fraction of boxes (B x 4) with IoU >= acc_iou_threshold to annot"
+        ious = torch.diag(IoU_values(boxes, annot))
+        return (ious >= self.acc_iou_threshold).float().mean()
 
 
 def get_default_eval(ratios, scales, cfg):
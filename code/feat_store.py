@@ -0,0 +1,129 @@
+"""
+Outputs of the frozen image encoder (x2, x3, x4) computed offline
+The encoder does not depend on the query, so training can
+start the forward pass at the language conditioned stages
+"""
+import json
+import zlib
+from pathlib import Path
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class FeatureStore:
+    """
+    float16 encoder outputs of every image, one level per file.
+    Uncompressed: feats_{l}.npy of num_imgs x C x H x W.
+    Compressed: feats_{l}.bin has the zlib compressed arrays
+    back to back and feats_{l}_offsets.npy where each one starts.
+    index.json has the shapes, the img_id and original
+    height, width of every row
+    """
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self.store_dir = Path(store_dir)
+        meta = json.load((self.store_dir / 'index.json').open('r'))
+        self.compress = meta['compress']
+        self.shapes = [tuple(sh) for sh in meta['shapes']]
+        self.index = {img_id: row for row, img_id in
+                      enumerate(meta['img_ids'])}
+        self.hw = meta['hw']
+        num_levels = len(self.shapes)
+        if self.compress:
+            self.data = [np.memmap(self.store_dir / f'feats_{l}.bin',
+                                   dtype=np.uint8, mode='r')
+                         for l in range(num_levels)]
+            self.offsets = [
+                np.load(self.store_dir / f'feats_{l}_offsets.npy')
+                for l in range(num_levels)]
+        else:
+            self.data = [np.load(self.store_dir / f'feats_{l}.npy',
+                                 mmap_mode='r')
+                         for l in range(num_levels)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_id: str):
+        return img_id in self.index
+
+    def get_hw(self, img_id: str) -> Tuple[int, int]:
+        "Original height, width of the image"
+        h, w = self.hw[self.index[img_id]]
+        return h, w
+
+    def get(self, img_id: str) -> List[np.ndarray]:
+        "C x H x W float16 features of each level"
+        row = self.index[img_id]
+        if not self.compress:
+            return [np.array(d[row]) for d in self.data]
+        out = []
+        for data, offsets, shape in zip(self.data, self.offsets,
+                                        self.shapes):
+            buf = zlib.decompress(data[offsets[row]: offsets[row + 1]])
+            out.append(np.frombuffer(
+                bytearray(buf), dtype=np.float16).reshape(shape))
+        return out
+
+
+def build_feature_store(store_dir: Union[str, Path], img_ids: List[str],
+                        load_fn: Callable[[str], Tuple[np.ndarray, int, int]],
+                        encode_fn: Callable[[torch.Tensor],
+                                            List[torch.Tensor]],
+                        bs: int = 16, compress: bool = False):
+    """
+    Writes the encoder outputs of `img_ids` in the `FeatureStore` format
+    load_fn: img_id -> H x W x 3 uint8 image (and h, w), see load_resized
+    encode_fn: B x 3 x H x W uint8 batch -> list of B x C x h x w features
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    img_ids = sorted(set(img_ids))
+    data, offsets, shapes = None, None, None
+    hw = []
+
+    for st in tqdm(range(0, len(img_ids), bs)):
+        imgs = []
+        for img_id in img_ids[st: st + bs]:
+            img, h, w = load_fn(img_id)
+            imgs.append(img)
+            hw.append([int(h), int(w)])
+        imgs = torch.from_numpy(np.stack(imgs)).permute(0, 3, 1, 2)
+        with torch.no_grad():
+            feats = [f.half().cpu().numpy() for f in encode_fn(imgs)]
+
+        if data is None:
+            shapes = [list(f.shape[1:]) for f in feats]
+            if compress:
+                data = [(store_dir / f'feats_{l}.bin').open('wb')
+                        for l in range(len(feats))]
+                offsets = [[0] for _ in feats]
+            else:
+                data = [np.lib.format.open_memmap(
+                    store_dir / f'feats_{l}.npy', mode='w+',
+                    dtype=np.float16, shape=(len(img_ids), *shapes[l]))
+                    for l in range(len(feats))]
+
+        for l, f in enumerate(feats):
+            if compress:
+                for feat in f:
+                    data[l].write(zlib.compress(feat.tobytes()))
+                    offsets[l].append(data[l].tell())
+            else:
+                data[l][st: st + len(f)] = f
+
+    for l in range(len(data)):
+        if compress:
+            data[l].close()
+            np.save(store_dir / f'feats_{l}_offsets.npy',
+                    np.array(offsets[l], dtype=np.int64))
+        else:
+            data[l].flush()
+    del data
+
+    meta = {'compress': compress, 'shapes': shapes, 'img_ids': img_ids,
+            'hw': hw}
+    json.dump(meta, (store_dir / 'index.json').open('w'))
@@ -0,0 +1,95 @@
+"""
+Images resized offline to the input size of the model
+Reading from the store needs no decoding at all
+"""
+import json
+from contextlib import nullcontext
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def load_resized(img_file: Union[str, Path], size: List[int],
+                 draft: bool = False) -> Tuple[np.ndarray, int, int]:
+    """
+    Decodes `img_file` and resizes it to `size` (w, h)
+    Returns the H x W x 3 uint8 image and the original height, width
+    draft: for JPEGs, let libjpeg decode at a reduced scale
+    (1/2, 1/4, 1/8) which is still at least `size`
+    """
+    img = Image.open(img_file)
+    # Original size, before draft changes it
+    w, h = img.size
+    if draft:
+        img.draft('RGB', (size[0], size[1]))
+    img = img.convert('RGB')
+    img = img.resize((size[0], size[1]))
+    return np.asarray(img), h, w
+
+
+class ImageStore:
+    """
+    Resized images of one split.
+    Images are in uint8 memmap shards of shard_size x H x W x 3
+    index.json has the size and for every img_id:
+    [shard, row, original height, original width]
+    """
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self.store_dir = Path(store_dir)
+        meta = json.load((self.store_dir / 'index.json').open('r'))
+        self.size = meta['size']
+        self.index = meta['index']
+        self.shards = [
+            np.load(self.store_dir / f'shard_{s:05d}.npy', mmap_mode='r')
+            for s in range(meta['num_shards'])
+        ]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_id: str):
+        return img_id in self.index
+
+    def get(self, img_id: str) -> Tuple[np.ndarray, int, int]:
+        "Same output as `load_resized`"
+        shard, row, h, w = self.index[img_id]
+        return np.array(self.shards[shard][row]), h, w
+
+
+def _load_resized_star(args):
+    return load_resized(*args)
+
+
+def build_image_store(store_dir: Union[str, Path], img_dir: Union[str, Path],
+                      img_ids: List[str], size: List[int],
+                      shard_size: int = 1024, nw: int = 4):
+    "Writes `img_ids` in `img_dir` resized to `size` in the `ImageStore` format"
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    img_ids = sorted(set(img_ids))
+    num_shards = (len(img_ids) + shard_size - 1) // shard_size
+    index = {}
+
+    args = [(Path(img_dir) / i, size) for i in img_ids]
+    # nw=0: in this process
+    with (Pool(nw) if nw > 0 else nullcontext()) as pool:
+        imgs = (pool.imap(_load_resized_star, args, chunksize=16)
+                if pool is not None else map(_load_resized_star, args))
+        for s in range(num_shards):
+            shard_ids = img_ids[s * shard_size: (s + 1) * shard_size]
+            shard = np.lib.format.open_memmap(
+                store_dir / f'shard_{s:05d}.npy', mode='w+', dtype=np.uint8,
+                shape=(len(shard_ids), size[1], size[0], 3))
+            for row, img_id in enumerate(tqdm(shard_ids, desc=f'shard {s}')):
+                shard[row], h, w = next(imgs)
+                index[img_id] = [s, row, h, w]
+            shard.flush()
+            del shard
+
+    meta = {'size': list(size), 'num_shards': num_shards, 'index': index}
+    json.dump(meta, (store_dir / 'index.json').open('w'))
@@ -1,8 +1,8 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from anchors import (create_anchors, simple_match_anchors,
-                     bbox_to_reg_params, IoU_values,tlbr2cthw)
+from anchors import (bbox_to_reg_params, IoU_values, create_att_targets,
+                     get_feat_sizes, get_anchor_grids, input_hw)
 from typing import Dict
 from functools import partial
 # from utils import reduce_dict
@@ -37,14 +37,90 @@ class ZSGLoss(nn.Module):
             self.loss_keys = ['loss', 'cls_ls', 'box_ls','att_ls']
         else:
             self.loss_keys = ['loss', 'cls_ls', 'box_ls']
-        self.anchs = None
-        self.get_anchors = partial(
-            create_anchors, ratios=self.ratios,
-            scales=self.scales, flatten=True)
+        # Targets as indices of the positive anchors instead of
+        # B x num_anchs masks
+        self.sparse_tgts = cfg['sparse_tgts']
+        # Anchors of every feature size, shared with the model
+        self.anchor_grids = get_anchor_grids(cfg, ratios, scales)
 
         self.box_loss = nn.SmoothL1Loss(reduction='none')
         self.att_losses=nn.BCEWithLogitsLoss()
 
+    def masks_from_inds(self, pos_inds, best_ind, num_anchs):
+        """
+        B x num_anchs masks of the positive anchors
+        and of the best anchor from their indices.
+        pos_inds is padded with -1, sent to an extra column
+        """
+        bs = pos_inds.size(0)
+        pos_inds = torch.where(pos_inds >= 0, pos_inds,
+                               pos_inds.new_tensor(num_anchs))
+        # Built from comparisons, so bool masks (uint8 before torch 1.2)
+        pos_mask = pos_inds.new_zeros(bs, num_anchs + 1).scatter_(
+            1, pos_inds, 1) > 0
+        best_mask = (torch.arange(num_anchs, device=best_ind.device)[None]
+                     == best_ind.view(-1, 1))
+        return pos_mask[:, :num_anchs], best_mask
+
+    @staticmethod
+    def inds_from_mask(mask):
+        """
+        B x P indices of the True entries of a B x num_anchs mask,
+        padded with -1. P is the largest number of True in a row
+        """
+        counts = mask.sum(1)
+        num_pos = int(counts.max()) if mask.size(0) > 0 else 0
+        _, inds = mask.to(torch.uint8).topk(num_pos, dim=1)
+        pad = (torch.arange(num_pos, device=mask.device)[None]
+               >= counts[:, None])
+        return inds.masked_fill(pad, -1)
+
+    @staticmethod
+    def add_best_ind(pos_inds, best_ind):
+        """
+        Indices of pos | best from pos_inds (padded with -1)
+        and the best anchor, and which of them are valid.
+        best_ind is only counted if it is not already positive
+        """
+        # Not negated with ~, masks are uint8 before torch 1.2
+        is_new = (pos_inds == best_ind.view(-1, 1)).sum(1) == 0
+        inds = torch.cat([pos_inds, best_ind.view(-1, 1)], dim=1)
+        valid = torch.cat([pos_inds >= 0, is_new.view(-1, 1)], dim=1)
+        return inds.clamp(min=0), valid
+
+    def sparse_box_loss(self, reg_box, anchs, annot, inds, valid):
+        """
+        Box loss of the anchors at inds (B x P) only.
+        Same as the masked mean over B x num_anchs
+        """
+        anc = anchs[inds]
+        reg = torch.gather(reg_box, 1, inds.unsqueeze(-1).expand(-1, -1, 4))
+        gt_reg_params = bbox_to_reg_params(anc, annot)
+        box_l = self.box_loss(reg, gt_reg_params).sum(dim=2) * valid.float()
+        box_l = box_l.sum(dim=1) / valid.sum(dim=1).float()
+        return box_l.mean()
+
+    def sparse_clas_loss(self, att_box, inds, valid):
+        """
+        (Focal) BCE loss without a dense target: every anchor gets the
+        loss of a negative, and the positives at inds (B x P)
+        replace it with the loss of a positive
+        """
+        neg_alpha, pos_alpha = ((self.alpha, 1 - self.alpha)
+                                if self.use_focal else (1., 1.))
+        # BCE with target 0 is softplus(x), with target 1 softplus(-x)
+        ps = torch.sigmoid(att_box)
+        neg_l = F.softplus(att_box) * neg_alpha
+        if self.use_focal:
+            neg_l = neg_l * ps.detach().pow(self.gamma)
+        att_pos = torch.gather(att_box, 1, inds)
+        ps_pos = torch.gather(ps, 1, inds)
+        pos_l = F.softplus(-att_pos) * pos_alpha
+        if self.use_focal:
+            pos_l = pos_l * (1 - ps_pos).detach().pow(self.gamma)
+        corr = (pos_l - torch.gather(neg_l, 1, inds)) * valid.float()
+        return neg_l.sum() + corr.sum()
+
     def forward(self, out: Dict[str, torch.tensor],
                 inp: Dict[str, torch.tensor]) -> Dict[str, torch.tensor]:
         """
@@ -54,78 +130,92 @@ class ZSGLoss(nn.Module):
         annot = inp['annot']
         att_box = out['att_out']
         reg_box = out['bbx_out']
-        feat_sizes = out['feat_sizes']
-        num_f_out = out['num_f_out']
         att_maps=out['att_maps']
 
+        if self.use_att_loss:
+            if self.cfg['att_tgt_on_device']:
+                # Only the gt box is sent by the data loader
+                iou_annots = create_att_targets(annot, self.in_size)
+            else:
+                iou_annots = [inp['iou_annot_stage_0'],
+                              inp['iou_annot_stage_1'],
+                              inp['iou_annot_stage_2']]
+
         if self.use_att_loss and not self.cfg.mdl_to_use == 'realgin':
             # self.loss_keys.append('att_ls')
-            iou_annot_stage_0 = inp['iou_annot_stage_0']
-            iou_annot_stage_1 = inp['iou_annot_stage_1']
-            iou_annot_stage_2 = inp['iou_annot_stage_2']
-            att_loss=self.att_losses(att_maps[0],iou_annot_stage_0)+self.att_losses(att_maps[1],iou_annot_stage_1)+self.att_losses(att_maps[2],iou_annot_stage_2)
+            att_loss=self.att_losses(att_maps[0],iou_annots[0])+self.att_losses(att_maps[1],iou_annots[1])+self.att_losses(att_maps[2],iou_annots[2])
             att_loss=att_loss/3.
         elif self.use_att_loss:
-            iou_annot = inp['iou_annot_stage_2']
-            att_loss = self.att_losses(att_maps[0], iou_annot)
+            att_loss = self.att_losses(att_maps[0], iou_annots[2])
         else:
-            att_loss=torch.zeros([1]).to(att_box.device)
+            att_loss = att_box.new_zeros([1])
         device = att_box.device
 
-        # get the correct number of output features
-        # in the case of DataParallel
-        if len(num_f_out) > 1:
-            num_f_out = int(num_f_out[0].item())
-        else:
-            num_f_out = int(num_f_out.item())
-
-        # Computes Anchors only once since size is kept fixed
-        # Needs to be changed in case size is not fixed
-        if self.anchs is None:
-            feat_sizes = feat_sizes[:num_f_out, :]
-            anchs = self.get_anchors(feat_sizes)
-            anchs = anchs.to(device)
-            self.anchs = anchs
+        # Feature sizes from the input size, no need to read
+        # out['feat_sizes'] from the device
+        feat_sizes = self.anchor_grids.feat_sizes(
+            input_hw(inp, self.cfg), out)
+        if 'best_ind' in inp:
+            # Targets from the data loader index the anchors of resize_img
+            assert feat_sizes == get_feat_sizes(
+                self.in_size, self.cfg.mdl_to_use)
+        anchs = self.anchor_grids.anchors(feat_sizes, device)
+        if 'best_ind' in inp:
+            # Assigned in the data loader (cfg.anchor_tgt_in_loader)
+            msk = inp['best_ind']
+            pos_inds = inp['pos_inds']
         else:
-            anchs = self.anchs
-        matches = simple_match_anchors(
-            anchs, annot, match_thr=self.cfg['matching_threshold'])
-        bbx_mask = (matches >= 0)
-        ious1 = IoU_values(annot, anchs)
-        _, msk = ious1.max(1)
-
-        bbx_mask2 = torch.eye(anchs.size(0))[msk]
-        bbx_mask2 = bbx_mask2 > 0
-        bbx_mask2 = bbx_mask2.to(device)
-        top1_mask = bbx_mask2
-
-        if not self.use_multi:
-            bbx_mask = bbx_mask2
+            ious1 = IoU_values(annot, anchs)
+            _, msk = ious1.max(1)
+            # Same as simple_match_anchors(...) >= 0
+            pos_mask = ious1 > self.cfg['matching_threshold']
+            pos_inds = None
+
+        if self.sparse_tgts:
+            # B x P indices of the anchors in bbx_mask, and which are valid
+            if not self.use_multi:
+                tgt_inds = msk.view(-1, 1)
+                tgt_valid = tgt_inds >= 0
+            else:
+                if pos_inds is None:
+                    pos_inds = self.inds_from_mask(pos_mask)
+                tgt_inds, tgt_valid = self.add_best_ind(pos_inds, msk)
+            box_loss = self.sparse_box_loss(reg_box, anchs, annot,
+                                            tgt_inds, tgt_valid)
         else:
-            bbx_mask = bbx_mask | bbx_mask2
-
-        # all clear
-        gt_reg_params = bbox_to_reg_params(anchs, annot)
-        box_l = self.box_loss(reg_box, gt_reg_params)
-        # box_l_relv = box_l.sum(dim=2)[bbx_mask]
-        box_l_relv = box_l.sum(dim=2) * bbx_mask.float()
-        box_l_relv = box_l_relv.sum(dim=1) / bbx_mask.sum(dim=-1).float()
-        box_loss = box_l_relv.mean()
-
-        if box_loss.cpu() == torch.Tensor([float("Inf")]):
-            # There is a likely bug with annot box
-            # being very small
-            import pdb
-            pdb.set_trace()
+            if pos_inds is not None:
+                bbx_mask, top1_mask = self.masks_from_inds(
+                    pos_inds, msk, anchs.size(0))
+            else:
+                bbx_mask = pos_mask
+                top1_mask = torch.zeros_like(pos_mask).scatter_(
+                    1, msk.view(-1, 1), True)
+
+            if not self.use_multi:
+                bbx_mask = top1_mask
+            else:
+                bbx_mask = bbx_mask | top1_mask
+
+            # all clear
+            gt_reg_params = bbox_to_reg_params(anchs, annot)
+            box_l = self.box_loss(reg_box, gt_reg_params)
+            # box_l_relv = box_l.sum(dim=2)[bbx_mask]
+            box_l_relv = box_l.sum(dim=2) * bbx_mask.float()
+            box_l_relv = box_l_relv.sum(dim=1) / bbx_mask.sum(dim=-1).float()
+            box_loss = box_l_relv.mean()
 
         att_box = att_box.squeeze(-1)
-        att_box_sigm = torch.sigmoid(att_box)
 
         if self.use_softmax:
             assert self.use_multi is False
             gt_ids = msk
             clas_loss = F.cross_entropy(att_box, gt_ids, reduction='none')
+            num_pos = msk.size(0)
+        elif self.sparse_tgts:
+            clas_loss = self.sparse_clas_loss(att_box, tgt_inds, tgt_valid)
+            num_pos = tgt_valid.sum()
         else:
+            att_box_sigm = torch.sigmoid(att_box)
             if self.use_focal:
                 encoded_tgt = bbx_mask.float()
                 ps = att_box_sigm
@@ -139,16 +229,17 @@ class ZSGLoss(nn.Module):
 
             clas_loss = F.binary_cross_entropy_with_logits(
                 att_box, bbx_mask.float(), weight=weights, reduction='none')
+            num_pos = bbx_mask.sum()
 
-        clas_loss = clas_loss.sum() / bbx_mask.sum()
+        clas_loss = clas_loss.sum() / num_pos
         # clas_loss = clas_loss.sum() / clas_loss.size(0)
 
-        if torch.isnan(box_loss) or torch.isnan(clas_loss):
-            # print('Nan Loss')
-            box_loss = box_loss.new_ones(box_loss.shape) * 0.01
-            box_loss.requires_grad = True
-            clas_loss = clas_loss.new_ones(clas_loss.shape)
-            clas_loss.requires_grad = True
+        # A non-finite loss (likely from a very small annot box)
+        # is replaced on the device, without a sync.
+        # The Learner also drops the gradients of the step
+        finite = torch.isfinite(box_loss) & torch.isfinite(clas_loss)
+        box_loss = torch.where(finite, box_loss, box_loss.new_tensor(0.01))
+        clas_loss = torch.where(finite, clas_loss, clas_loss.new_tensor(1.))
 
         if self.use_att_loss:
             out_loss = self.lamb_reg * box_loss + clas_loss+att_loss
@@ -161,6 +252,7 @@ class ZSGLoss(nn.Module):
         out_dict['box_ls'] = box_loss
         if self.use_att_loss:
             out_dict['att_ls']=att_loss
+        out_dict['finite'] = finite
         # out_dict['rel_ls'] = rel_loss
 
         return out_dict
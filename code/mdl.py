@@ -2,21 +2,41 @@
 Model file for zsgnet
 Author: Arka Sadhu
 """
+import contextlib
 import torch
 import torch.nn as nn
-# import torch.nn.functional as F
+import torch.nn.functional as F
+import numpy as np
 import torchvision.models as tvm
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from fpn_resnet import FPN_backbone
-from anchors import create_grid
+from anchors import get_anchor_grids, NonPersistentBuffers
 import ssd_vgg
 from typing import Dict, Any
 from extended_config import cfg as conf
-from dat_loader import get_data
+from dat_loader import get_data, get_tok_store_dir
+from tok_store import load_word_vecs, PAD_ID
 from afs import AdaptiveFeatureSelection
 from garan import GaranAttention
 from darknet import darknet53
 
+# inference_mode needs torch >= 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def autocast(device_type: str, dtype: torch.dtype, enabled: bool = True):
+    """
+    torch.autocast needs torch >= 1.10, before it only float16
+    on cuda (torch >= 1.6) is available, otherwise runs as is
+    """
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+    if (device_type == 'cuda' and dtype == torch.float16 and
+            hasattr(torch.cuda, 'amp')):
+        return torch.cuda.amp.autocast(enabled=enabled)
+    return contextlib.nullcontext()
+
+
 # conv2d, conv2d_relu are adapted from
 # https://github.com/fastai/fastai/blob/5c4cefdeaf11fdbbdf876dbe37134c118dca03ad/fastai/layers.py#L98
 def conv2d(ni: int, nf: int, ks: int = 3, stride: int = 1,
@@ -60,11 +80,22 @@ class BackBone(nn.Module):
         self.encoder = encoder
         self.cfg = cfg
         self.out_chs = out_chs
+        # Grid centers of every feature size, made once
+        self.anchor_grids = get_anchor_grids(cfg)
+        if cfg['frozen_enc_fast'] and cfg['enc_channels_last']:
+            self.encoder.to(memory_format=torch.channels_last)
         self.after_init()
 
     def after_init(self):
         pass
 
+    def train(self, mode=True):
+        super().train(mode)
+        if self.cfg['frozen_enc_fast']:
+            # Frozen encoder, BatchNorm keeps the running statistics
+            self.encoder.eval()
+        return self
+
     def num_channels(self):
         raise NotImplementedError
 
@@ -79,9 +110,7 @@ class BackBone(nn.Module):
         assert not (only_we and only_grid)
 
         # Create the grid
-        grid = create_grid((x.size(2), x.size(3)),
-                           flatten=False).to(self.device)
-        grid = grid.permute(2, 0, 1).contiguous()
+        grid = self.anchor_grids.grid((x.size(2), x.size(3)), x.device)
 
         # TODO: Slightly cleaner implementation?
         grid_tile = grid.view(
@@ -105,17 +134,58 @@ class BackBone(nn.Module):
         # Concatenate along the channel dimension
         return torch.cat((x, word_emb_tile, grid_tile), dim=1)
 
-    def encode_feats(self, inp):
-        return self.encoder(inp)
+    def encode_img(self, inp):
+        "Language independent part of encode_feats"
+        raise NotImplementedError
+
+    def encode_lang(self, img_feats, lang):
+        "Language conditioned part of encode_feats"
+        raise NotImplementedError
 
-    def forward(self, inp, we=None,
-                only_we=False, only_grid=False):
+    def run_encoder(self, inp):
+        """
+        encode_img. With cfg.frozen_enc_fast the frozen encoder
+        runs without autograd, optionally in cfg.enc_dtype
+        and channels last memory format
+        """
+        if not self.cfg['frozen_enc_fast']:
+            return self.encode_img(inp)
+        dtype = getattr(torch, self.cfg['enc_dtype'])
+        with inference_mode():
+            if self.cfg['enc_channels_last']:
+                inp = inp.contiguous(memory_format=torch.channels_last)
+            with autocast(inp.device.type, dtype=dtype,
+                          enabled=dtype != torch.float32):
+                feats = self.encode_img(inp)
+        # Inference tensors can't be saved for backward,
+        # copy them to normal float32 tensors
+        if self.cfg['enc_channels_last']:
+            return [f.to(torch.float32, memory_format=torch.contiguous_format,
+                         copy=True) for f in feats]
+        return [f.to(torch.float32, copy=True) for f in feats]
+
+    def encode_feats(self, inp, lang, img_inds=None, img_feats=None):
+        """
+        img_inds: Optional B, image of every query in inp.
+        If given, inp has only the unique images and
+        the encoder outputs are gathered per query
+        img_feats: Optional encoder outputs computed offline,
+        then inp is not used
+        """
+        if img_feats is None:
+            img_feats = self.run_encoder(inp)
+        if img_inds is not None:
+            img_feats = [f.index_select(0, img_inds) for f in img_feats]
+        return self.encode_lang(img_feats, lang)
+
+    def forward(self, inp, we=None, only_we=False, only_grid=False,
+                img_inds=None, img_feats=None):
         """
         expecting word embedding of shape B x WE.
         If only image features are needed, don't
         provide any word embedding
         """
-        feats,att_maps = self.encode_feats(inp,we)
+        feats,att_maps = self.encode_feats(inp, we, img_inds, img_feats)
         # If we want to do normalization of the features
         if self.cfg['do_norm']:
             feats = [
@@ -153,7 +223,7 @@ class RetinaBackBone(BackBone):
                 self.encoder.layer3[-1].conv3.out_channels,
                 self.encoder.layer4[-1].conv3.out_channels]
 
-    def encode_feats(self, inp,lang):
+    def encode_img(self, inp):
         x = self.encoder.conv1(inp)
         x = self.encoder.bn1(x)
         x = self.encoder.relu(x)
@@ -162,6 +232,10 @@ class RetinaBackBone(BackBone):
         x2 = self.encoder.layer2(x1)
         x3 = self.encoder.layer3(x2)
         x4 = self.encoder.layer4(x3)
+        return [x2, x3, x4]
+
+    def encode_lang(self, img_feats, lang):
+        x2, x3, x4 = img_feats
         # print(lang.size())
         x2_ = self.afs_stage0(lang,[x2, x3, x4])
         x2_,E_1=self.garan_stage0(lang,x2_)
@@ -190,8 +264,11 @@ class YoloBackBone(BackBone):
         self.garan_stage = GaranAttention(2048, 1024, n_head=4).to(self.device)
     def num_channels(self):
         return [256, 512, 1024]
-    def encode_feats(self, inp,lang):
-        x2, x3, x4 = self.encoder(inp)
+    def encode_img(self, inp):
+        return list(self.encoder(inp))
+
+    def encode_lang(self, img_feats, lang):
+        x2, x3, x4 = img_feats
         # print(lang.size())
         
         x_ = self.afs_stage(lang,[x2, x3, x4])
@@ -201,7 +278,7 @@ class YoloBackBone(BackBone):
         return [feats], [E]
 
 
-class ZSGNet(nn.Module):
+class ZSGNet(NonPersistentBuffers):
     """
     The main model
     Uses SSD like architecture but for Lang+Vision
@@ -217,6 +294,7 @@ class ZSGNet(nn.Module):
         self.device = torch.device(cfg.device)
 
         self.cfg = cfg
+        self.anchor_grids = get_anchor_grids(cfg)
 
         # should be len(ratios) * len(scales)
         self.n_anchors = n_anchors
@@ -265,6 +343,27 @@ class ZSGNet(nn.Module):
         else:
             self.gru = nn.GRU(self.emb_dim, self.lstm_dim, 
                                 bidirectional=self.bid, batch_first=False)
+
+        # Initial state of the lstm, see lstm_init_hidden
+        self.lstm_init = self.cfg['lstm_init']
+        if self.lstm_init == 'learned':
+            num_dirs = 2 if self.bid else 1
+            self.hidden0 = nn.Parameter(
+                torch.zeros(num_dirs, 1, self.lstm_dim))
+            if self.is_lstm:
+                self.cell0 = nn.Parameter(
+                    torch.zeros(num_dirs, 1, self.lstm_dim))
+        # See inference()
+        self.infer = False
+        self.train_before_infer = True
+
+        # Queries tokenized offline (see tok_store.py)
+        # The table is fixed, so it is not saved with the model
+        if self.cfg['use_tok_ids']:
+            word_vecs = load_word_vecs(
+                get_tok_store_dir(self.cfg, self.cfg.ds_to_use))
+            self.register_nonpersistent(
+                'word_vecs', torch.from_numpy(np.array(word_vecs)))
         self.after_init()
 
     def after_init(self):
@@ -306,9 +405,7 @@ class ZSGNet(nn.Module):
                                              x.size(2), x.size(3))
 
         if append_grid_centers:
-            grid = create_grid((x.size(2), x.size(3)),
-                               flatten=False).to(self.device)
-            grid = grid.permute(2, 0, 1).contiguous()
+            grid = self.anchor_grids.grid((x.size(2), x.size(3)), x.device)
             grid_tile = grid.view(1, grid.size(0), grid.size(1), grid.size(2)).expand(
                 we.size(0), grid.size(0), grid.size(1), grid.size(2))
 
@@ -318,8 +415,21 @@ class ZSGNet(nn.Module):
     def lstm_init_hidden(self, bs):
         """
         Initialize the very first hidden state of LSTM
-        Basically, the LSTM should be independent of this
+        Basically, the LSTM should be independent of this.
+        cfg.lstm_init: 'randn', 'zeros' or 'learned'.
+        None makes the LSTM start from zeros
         """
+        if self.lstm_init == 'learned':
+            num_dirs = 2 if self.bid else 1
+            hidden_a = self.hidden0.expand(
+                num_dirs, bs, self.lstm_dim).contiguous()
+            if not self.is_lstm:
+                return hidden_a
+            hidden_b = self.cell0.expand(
+                num_dirs, bs, self.lstm_dim).contiguous()
+            return (hidden_a, hidden_b)
+        if self.lstm_init == 'zeros' or self.infer:
+            return None
         if not self.bid:
             hidden_a = torch.randn(1, bs, self.lstm_dim)
             hidden_b = torch.randn(1, bs, self.lstm_dim)
@@ -334,11 +444,14 @@ class ZSGNet(nn.Module):
         else:
             return hidden_a
 
-    def apply_lstm(self, word_embs, qlens, max_qlen, get_full_seq=False):
+    def apply_lstm(self, word_embs, qlens, max_qlen, get_full_seq=False,
+                   qlens_cpu=None):
         """
         Applies lstm function.
         word_embs: word embeddings, B x seq_len x 300
         qlen: length of the phrases
+        qlens_cpu: (optional) the same lengths on the host,
+        pack_padded_sequence would otherwise copy them there
         Try not to fiddle with this function.
         IT JUST WORKS
         """
@@ -347,14 +460,20 @@ class ZSGNet(nn.Module):
         # bid x B x L
         self.hidden = self.lstm_init_hidden(bs)
         # B x 1, B x 1
-        qlens1, perm_idx = qlens.sort(0, descending=True)
+        if qlens_cpu is not None and not qlens_cpu.is_cuda:
+            lens_sorted, perm_idx = qlens_cpu.sort(0, descending=True)
+            perm_idx = perm_idx.to(word_embs.device, non_blocking=True)
+            qlens1 = qlens[perm_idx]
+        else:
+            qlens1, perm_idx = qlens.sort(0, descending=True)
+            lens_sorted = qlens1
         # B x T x E (permuted)
         qtoks = word_embs[perm_idx]
         # T x B x E
         embeds = qtoks.permute(1, 0, 2).contiguous()
         # Packed Embeddings
         packed_embed_inp = pack_padded_sequence(
-            embeds, lengths=qlens1, batch_first=False)
+            embeds, lengths=lens_sorted, batch_first=False)
         # To ensure no pains with DataParallel
         # self.lstm.flatten_parameters()
         if self.is_lstm:
@@ -379,12 +498,45 @@ class ZSGNet(nn.Module):
             return lstm_out_1
         return qvec_out.contiguous()
 
+    def normalize_img(self, img):
+        """
+        Images come from the data loader as uint8
+        to keep the transfers small, convert once per batch here
+        """
+        if img.dtype == torch.uint8:
+            img = img.float().div_(255)
+        return img
+
+    def unique_imgs(self, img, img_inds):
+        """
+        Queries of the same image share the image encoder pass.
+        img_inds: B, rows with the same value have the same image
+        Returns the unique images and for every row the index
+        of its image among them
+        """
+        _, inv = torch.unique(img_inds, return_inverse=True)
+        n = len(img_inds)
+        rows = torch.arange(n, device=img_inds.device)
+        # Sorted by image then row, the first row of every image
+        # starts a new group
+        keys, _ = (inv * n + rows).sort()
+        grps = keys // n
+        starts = torch.cat([
+            keys.new_zeros(1), (grps[1:] != grps[:-1]).nonzero().view(-1) + 1])
+        first = keys[starts] % n
+        return img.index_select(0, first), inv
+
     def forward(self, inp: Dict[str, Any]):
         """
         Forward method of the model
         inp0 : image to be used
         inp1 : word embeddings, B x seq_len x 300
+        (or qids: token ids looked up in word_vecs)
         qlens: length of phrases
+        img_inds: (optional) queries with the same value
+        share the image, encoded only once
+        img_feat_0/1/2: (optional) encoder outputs from the
+        feature store, used instead of img
 
         The following is performed:
         1. Get final hidden state features of lstm
@@ -395,28 +547,54 @@ class ZSGNet(nn.Module):
         4. Use the classification, regression head on this concatenated features
         The matching with groundtruth is done in loss function and evaluation
         """
-        inp0 = inp['img']
-        inp1 = inp['qvec']
+        if 'img_feat_0' in inp:
+            # Encoder outputs from the feature store
+            inp0 = None
+            img_feats = [inp[f'img_feat_{l}'].float() for l in range(3)]
+        else:
+            inp0 = self.normalize_img(inp['img'])
+            img_feats = None
+        if 'qids' in inp:
+            qids = inp['qids'].long()
+            # Before torch 1.6 word_vecs is not copied to
+            # the DataParallel replicas (see NonPersistentBuffers)
+            inp1 = F.embedding(qids, self.word_vecs.to(qids.device),
+                               padding_idx=PAD_ID)
+        else:
+            inp1 = inp['qvec']
         qlens = inp['qlens']
-        max_qlen = int(qlens.max().item())
-        req_embs = inp1[:, :max_qlen, :].contiguous()
+        # The collater already cuts the queries to the longest one,
+        # its length is known without reading qlens from the device
+        max_qlen = inp1.size(1)
+        req_embs = inp1.contiguous()
+
+        req_emb = self.apply_lstm(req_embs, qlens, max_qlen,
+                                  qlens_cpu=inp.get('qlens_cpu'))
 
-        req_emb = self.apply_lstm(req_embs, qlens, max_qlen)
+        img_inds = None
+        if 'img_inds' in inp and inp0 is not None:
+            inp0, img_inds = self.unique_imgs(inp0, inp['img_inds'])
 
         # image blind
         if self.cfg['use_lang'] and not self.cfg['use_img']:
             # feat_out = self.backbone(inp0)
-            feat_out,E_attns = self.backbone(inp0, req_emb, only_we=True)
+            feat_out,E_attns = self.backbone(
+                inp0, req_emb, only_we=True, img_inds=img_inds,
+                img_feats=img_feats)
 
         # language blind
         elif self.cfg['use_img'] and not self.cfg['use_lang']:
-            feat_out,E_attns = self.backbone(inp0)
+            feat_out,E_attns = self.backbone(
+                inp0, img_inds=img_inds, img_feats=img_feats)
 
         elif not self.cfg['use_img'] and not self.cfg['use_lang']:
-            feat_out,E_attns = self.backbone(inp0, req_emb, only_grid=True)
+            feat_out,E_attns = self.backbone(
+                inp0, req_emb, only_grid=True, img_inds=img_inds,
+                img_feats=img_feats)
         # see full language + image (happens by default)
         else:
-            feat_out,E_attns = self.backbone(inp0, req_emb)
+            feat_out,E_attns = self.backbone(
+                inp0, req_emb, img_inds=img_inds, img_feats=img_feats)
 
         # Strategy depending on shared head or not
         if self.cfg['use_same_atb']:
@@ -432,20 +610,37 @@ class ZSGNet(nn.Module):
                 [self.permute_correctly(self.reg_box(feature), 4)
                  for feature in feat_out], dim=1)
 
-        feat_sizes = torch.tensor([[f.size(2), f.size(3)]
-                                   for f in feat_out]).to(self.device)
-
-        # Used mainly due to dataparallel consistency
-        num_f_out = torch.tensor([len(feat_out)]).to(self.device)
+        # num_f_out is used mainly due to dataparallel consistency.
+        # Both are made once, see AnchorGrids
+        feat_sizes, num_f_out = self.anchor_grids.sizes_tensors(
+            [(f.size(2), f.size(3)) for f in feat_out], att_out.device)
 
         out_dict = {}
         out_dict['att_out'] = att_out
         out_dict['bbx_out'] = bbx_out
         out_dict['feat_sizes'] = feat_sizes
         out_dict['num_f_out'] = num_f_out
-        out_dict['att_maps'] = E_attns
+        if not self.infer:
+            # Only needed by the loss
+            out_dict['att_maps'] = E_attns
         return out_dict
 
+    def inference(self, mode: bool = True):
+        """
+        Inference mode (also sets eval mode, inference(False) restores
+        the previous one): the lstm starts from zeros
+        (or the learned state) instead of random values,
+        and att_maps are not returned
+        """
+        if mode == self.infer:
+            return self
+        self.infer = mode
+        if mode:
+            self.train_before_infer = self.training
+            return self.eval()
+        # Back to the mode from before inference()
+        return self.train(self.train_before_infer)
+
 
 def get_default_net(num_anchors=1, cfg=None):
     """
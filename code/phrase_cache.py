@@ -0,0 +1,88 @@
+"""
+Cache of query embeddings keyed by the phrase text
+The same phrases repeat across images and epochs,
+so the spacy pipeline only needs to be run once per phrase
+"""
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+QvecOut = Tuple[int, np.ndarray]
+
+
+class PhraseEmbCache:
+    """
+    Two tier cache of phrase -> (qlen, phrase_len x emb_dim vectors)
+    1. On-disk tier: memory-mapped arrays written by `build_phrase_cache`.
+    Opened read-only, so the pages are shared by all DataLoader workers
+    2. In-process tier: LRU of bounded size, filled by `compute_fn`
+    for phrases missing from the on-disk tier
+    """
+
+    def __init__(self, cache_dir: Union[str, Path],
+                 compute_fn: Callable[[str], QvecOut],
+                 lru_size: int = 10000):
+        self.cache_dir = Path(cache_dir)
+        self.compute_fn = compute_fn
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+
+        self.phrase_to_row = {}
+        self.qlens = None
+        self.vecs = None
+        # phrases.json is written last, so the cache is complete if it exists
+        phrase_file = self.cache_dir / 'phrases.json'
+        if phrase_file.exists():
+            phrases = json.load(phrase_file.open('r'))
+            self.phrase_to_row = {p: i for i, p in enumerate(phrases)}
+            self.qlens = np.load(self.cache_dir / 'qlens.npy', mmap_mode='r')
+            self.vecs = np.load(self.cache_dir / 'vecs.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.phrase_to_row)
+
+    def get(self, phrase: str) -> QvecOut:
+        "Returns qlen and the word vectors of `phrase`"
+        row = self.phrase_to_row.get(phrase)
+        if row is not None:
+            return int(self.qlens[row]), np.array(self.vecs[row])
+
+        if phrase in self.lru:
+            self.lru.move_to_end(phrase)
+            return self.lru[phrase]
+
+        out = self.compute_fn(phrase)
+        self.lru[phrase] = out
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+        return out
+
+
+def build_phrase_cache(phrases: List[str], cache_dir: Union[str, Path],
+                       compute_fn: Callable[[str], QvecOut],
+                       phrase_len: int = 50, emb_dim: int = 300):
+    """
+    Offline pass which computes the embeddings of all `phrases`
+    and writes the on-disk tier of `PhraseEmbCache`
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    phrases = sorted(set(phrases))
+
+    qlens = np.lib.format.open_memmap(
+        cache_dir / 'qlens.npy', mode='w+', dtype=np.int32,
+        shape=(len(phrases),))
+    vecs = np.lib.format.open_memmap(
+        cache_dir / 'vecs.npy', mode='w+', dtype=np.float32,
+        shape=(len(phrases), phrase_len, emb_dim))
+    for ind, phrase in enumerate(tqdm(phrases)):
+        qlens[ind], vecs[ind] = compute_fn(phrase)
+    qlens.flush()
+    vecs.flush()
+    del qlens, vecs
+
+    json.dump(phrases, (cache_dir / 'phrases.json').open('w'))
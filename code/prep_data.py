@@ -0,0 +1,138 @@
+"""
+Offline preparation of the caches used by the data loader
+Run from the root directory, for example:
+python code/prep_data.py phrase_cache --ds_to_use='refclef'
+Any argument of configs/cfg.json can be changed the same way
+as in main_dist.py
+"""
+from functools import partial
+from pathlib import Path
+
+import fire
+import torch
+
+from dat_loader import (ImgQuDataset, compute_qvec, get_csv_files,
+                        get_phrase_cache_dir, get_tok_store_dir, get_nlp,
+                        get_img_store_dir, get_ann_store_dir, get_shard_dir,
+                        get_feat_store_dir)
+from img_store import build_image_store
+from ann_store import build_ann_store
+from phrase_cache import build_phrase_cache
+from shard_store import build_shards
+from feat_store import build_feature_store
+from anchors import get_ratios_scales
+from mdl import get_default_net
+from tok_store import build_token_store
+from extended_config import cfg as conf, key_maps, update_from_dict
+
+
+def get_cfg(kwargs):
+    cfg = update_from_dict(conf, kwargs, key_maps)
+    # The caches are read from disk, so always compute from scratch here
+    cfg.use_phrase_cache = False
+    cfg.use_tok_ids = False
+    cfg.use_img_store = False
+    cfg.use_ann_store = False
+    cfg.use_shards = False
+    cfg.shm_cache_mb = 0
+    cfg.use_feat_store = False
+    return cfg
+
+
+def get_datasets(cfg):
+    "One ImgQuDataset per csv file of the dataset"
+    ds_name = cfg.ds_to_use
+    return {
+        split: ImgQuDataset(cfg=cfg, csv_file=csv_file,
+                            ds_name=ds_name, split_type=split)
+        for split, csv_file in get_csv_files(cfg, ds_name).items()
+    }
+
+
+def phrase_cache(**kwargs):
+    "Computes spacy embeddings of every query of the dataset"
+    cfg = get_cfg(kwargs)
+    phrases = set()
+    for ds in get_datasets(cfg).values():
+        phrases.update(q for q in ds.get_all_queries() if q)
+    phrase_len = ds.phrase_len
+    build_phrase_cache(
+        sorted(phrases), get_phrase_cache_dir(cfg, cfg.ds_to_use),
+        partial(compute_qvec, phrase_len=phrase_len),
+        phrase_len=phrase_len, emb_dim=cfg.emb_dim)
+
+
+def tok_ids(**kwargs):
+    "Converts every query of the dataset to token ids"
+    cfg = get_cfg(kwargs)
+    csv_queries = {}
+    for ds in get_datasets(cfg).values():
+        csv_queries[Path(ds.ann_file).stem] = ds.get_row_queries()
+    build_token_store(
+        get_tok_store_dir(cfg, cfg.ds_to_use), csv_queries, get_nlp(),
+        phrase_len=ds.phrase_len, emb_dim=cfg.emb_dim)
+
+
+def img_store(shard_size=1024, **kwargs):
+    "Resizes the images of every split of the dataset to cfg.resize_img"
+    cfg = get_cfg(kwargs)
+    for ds in get_datasets(cfg).values():
+        build_image_store(
+            get_img_store_dir(cfg, cfg.ds_to_use, ds.ann_file), ds.img_dir,
+            ds.get_img_ids(), cfg.resize_img, shard_size=shard_size,
+            nw=cfg.nw)
+
+
+def ann_store(**kwargs):
+    "Converts the csv files of the dataset to the columnar format"
+    cfg = get_cfg(kwargs)
+    for ds in get_datasets(cfg).values():
+        build_ann_store(
+            get_ann_store_dir(cfg, cfg.ds_to_use, ds.ann_file),
+            ds.image_data)
+
+
+def shards(shard_size=1000, **kwargs):
+    """
+    Packs the images and annotations of every split
+    in tar shards of `shard_size` images
+    """
+    cfg = get_cfg(kwargs)
+    for ds in get_datasets(cfg).values():
+        build_shards(
+            get_shard_dir(cfg, cfg.ds_to_use, ds.ann_file),
+            ([idx, *ds.get_row(idx)] for idx in range(len(ds))),
+            ds.img_dir, shard_size=shard_size)
+
+
+def feats(bs=16, compress=False, **kwargs):
+    """
+    Runs the frozen image encoder of cfg.mdl_to_use on the images
+    of every split at cfg.resize_img and stores the outputs in float16
+    compress: zlib compress the features of every image
+    """
+    cfg = get_cfg(kwargs)
+    device = torch.device(cfg.device)
+    ratios, scales = get_ratios_scales(cfg)
+    mdl = get_default_net(num_anchors=len(ratios) * len(scales), cfg=cfg)
+    mdl = mdl.to(device).eval()
+
+    def encode_fn(imgs):
+        return mdl.backbone.encode_img(mdl.normalize_img(imgs.to(device)))
+
+    for ds in get_datasets(cfg).values():
+        build_feature_store(
+            get_feat_store_dir(cfg, cfg.ds_to_use, ds.ann_file),
+            ds.get_img_ids(), ds.load_img, encode_fn, bs=bs,
+            compress=compress)
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'phrase_cache': phrase_cache,
+        'tok_ids': tok_ids,
+        'img_store': img_store,
+        'ann_store': ann_store,
+        'shards': shards,
+        'feats': feats,
+    })
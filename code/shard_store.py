@@ -0,0 +1,202 @@
+"""
+Annotations and encoded images packed in sequential tar shards
+All the rows of an image are stored next to its bytes,
+so a split is read with large sequential reads instead of
+one random file access per sample
+"""
+import io
+import json
+import queue
+import random
+import tarfile
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Tuple, Union
+
+from tqdm import tqdm
+
+# img_id, encoded image, rows: [idx, x1, y1, x2, y2, queries]
+ShardRecord = Tuple[str, bytes, List[list]]
+
+
+def add_member(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def build_shards(store_dir: Union[str, Path], rows: Iterable[list],
+                 img_dir: Union[str, Path], shard_size: int = 1000):
+    """
+    Writes shard_{s:05d}.tar files with `shard_size` images each.
+    rows: idx, img_id, x1, y1, x2, y2, queries for every row of the csv.
+    An image is stored as {n}.img with the file bytes as is, followed by
+    {n}.json with the img_id and its rows.
+    index.json has the shard names and the number of rows in each
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    img_rows = {}
+    for idx, img_id, x1, y1, x2, y2, queries in rows:
+        img_rows.setdefault(f'{img_id}', []).append(
+            [int(idx), float(x1), float(y1), float(x2), float(y2), queries])
+    img_ids = list(img_rows)
+
+    shards, num_rows = [], []
+    for st in range(0, len(img_ids), shard_size):
+        name = f'shard_{st // shard_size:05d}.tar'
+        shard_ids = img_ids[st: st + shard_size]
+        with tarfile.open(store_dir / name, 'w') as tar:
+            for n, img_id in enumerate(tqdm(shard_ids, desc=name)):
+                key = f'{st + n:08d}'
+                add_member(tar, f'{key}.img',
+                           (Path(img_dir) / img_id).read_bytes())
+                meta = {'img_id': img_id, 'rows': img_rows[img_id]}
+                add_member(tar, f'{key}.json', json.dumps(meta).encode())
+        shards.append(name)
+        num_rows.append(sum(len(img_rows[i]) for i in shard_ids))
+
+    index = {'shards': shards, 'num_rows': num_rows}
+    json.dump(index, (store_dir / 'index.json').open('w'))
+
+
+def read_shard(shard_file: Union[str, Path]) -> Iterator[ShardRecord]:
+    "Records of a shard, read sequentially"
+    with tarfile.open(shard_file, 'r|') as tar:
+        img_bytes = None
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.img'):
+                img_bytes = data
+            else:
+                meta = json.loads(data)
+                yield meta['img_id'], img_bytes, meta['rows']
+
+
+def read_shard_rows(shard_file: Union[str, Path], lo: int,
+                    hi: int) -> Iterator[ShardRecord]:
+    """
+    Records of a shard with only its rows lo..hi
+    (counted over the whole shard), images without any are left out
+    """
+    num = 0
+    for img_id, img_bytes, rows in read_shard(shard_file):
+        take = rows[max(lo - num, 0): hi - num]
+        num += len(rows)
+        if take:
+            yield img_id, img_bytes, take
+        if num >= hi:
+            return
+
+
+def read_ahead(jobs: Iterable, num_read_ahead: int = 64,
+               read_fn: Callable[..., Iterator[ShardRecord]] = read_shard
+               ) -> Iterator[ShardRecord]:
+    """
+    Records of read_fn(job) for every job (a shard file for read_shard),
+    read in a background thread keeping up to `num_read_ahead` of them ready
+    """
+    rec_queue = queue.Queue(maxsize=num_read_ahead)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                rec_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read():
+        try:
+            for job in jobs:
+                for rec in read_fn(job):
+                    if stop.is_set():
+                        return
+                    put(rec)
+        except Exception as e:
+            put(e)
+        put(done)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            rec = rec_queue.get()
+            if rec is done:
+                break
+            if isinstance(rec, Exception):
+                raise rec
+            yield rec
+    finally:
+        stop.set()
+        thread.join()
+
+
+def part_range(total: int, part: int, num_parts: int) -> Tuple[int, int]:
+    "Start, stop of `part` when `total` items are split as evenly as possible"
+    start = total // num_parts * part + min(part, total % num_parts)
+    return start, start + total // num_parts + int(part < total % num_parts)
+
+
+def shuffle_buffer(items: Iterable, buffer_size: int,
+                   rng: random.Random) -> Iterator:
+    """
+    Approximate shuffle of a stream: items are kept in a buffer
+    and a random one is emitted each time a new one comes in
+    """
+    buf = []
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        ind = rng.randrange(buffer_size)
+        yield buf[ind]
+        buf[ind] = item
+    rng.shuffle(buf)
+    yield from buf
+
+
+class ShardIndex:
+    "index.json of a shard directory"
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self.store_dir = Path(store_dir)
+        index = json.load((self.store_dir / 'index.json').open('r'))
+        self.shards = [self.store_dir / s for s in index['shards']]
+        self.num_rows = index['num_rows']
+
+    def __len__(self):
+        return sum(self.num_rows)
+
+    def order(self, shuffle: bool = False, seed: int = 0) -> List[int]:
+        """
+        Shards in the order they are read in an epoch.
+        All readers shuffle with the same seed
+        """
+        inds = list(range(len(self.shards)))
+        if shuffle:
+            random.Random(seed).shuffle(inds)
+        return inds
+
+    def row_ranges(self, start: int, stop: int, shuffle: bool = False,
+                   seed: int = 0) -> Iterator[Tuple[Path, int, int]]:
+        """
+        Rows start..stop of the rows of all the shards in `order`,
+        as (shard file, lo, hi) of the shards they are in.
+        Past the last row it starts again from the first one
+        """
+        if start >= stop or len(self) == 0:
+            return
+        inds = self.order(shuffle, seed)
+        offset = 0
+        while True:
+            for ind in inds:
+                num = self.num_rows[ind]
+                lo, hi = max(start - offset, 0), min(stop - offset, num)
+                if lo < hi:
+                    yield self.shards[ind], lo, hi
+                offset += num
+                if offset >= stop:
+                    return
@@ -0,0 +1,143 @@
+"""
+Cache of decoded and resized images in shared memory
+Created before the DataLoader workers start, so all of them
+(and every later epoch) see the same images
+"""
+import hashlib
+import multiprocessing as mp
+import os
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    raise ImportError('shm_cache_mb > 0 needs python 3.8+ '
+                      '(multiprocessing.shared_memory)')
+from typing import Optional, Tuple
+
+import numpy as np
+
+# hits, misses
+NUM_COUNTERS = 2
+
+
+def key_of(img_key: str) -> int:
+    "Stable 64 bit key, python hash() differs across processes"
+    return int.from_bytes(
+        hashlib.blake2b(img_key.encode(), digest_size=8).digest(),
+        'little', signed=True)
+
+
+class SharedImageCache:
+    """
+    Fixed number of slots of `slot_shape` uint8 images,
+    with CLOCK eviction: every hit sets the reference bit of the slot,
+    the hand clears bits until it finds a slot to replace.
+    The data and the bookkeeping arrays are in shared memory,
+    protected by a single lock
+    """
+
+    def __init__(self, budget_mb: float, slot_shape: Tuple[int, ...]):
+        self.slot_shape = tuple(slot_shape)
+        slot_bytes = int(np.prod(self.slot_shape))
+        self.num_slots = max(int(budget_mb * 2 ** 20) // slot_bytes, 1)
+        self.lock = mp.Lock()
+        # Only the creating process unlinks the memory, forked
+        # DataLoader workers get a copy of this object as is
+        self.owner_pid = os.getpid()
+
+        self.data_shm = shared_memory.SharedMemory(
+            create=True, size=self.num_slots * slot_bytes)
+        # keys, h, w, ref bits, valid, then the hand and counters
+        self.meta_shm = shared_memory.SharedMemory(
+            create=True, size=8 * (5 * self.num_slots + 1 + NUM_COUNTERS))
+        self.attach()
+        self.meta[:] = 0
+
+    def attach(self):
+        "numpy views on the shared memory"
+        self.data = np.ndarray((self.num_slots, *self.slot_shape),
+                               dtype=np.uint8, buffer=self.data_shm.buf)
+        self.meta = np.ndarray(5 * self.num_slots + 1 + NUM_COUNTERS,
+                               dtype=np.int64, buffer=self.meta_shm.buf)
+        n = self.num_slots
+        self.keys = self.meta[:n]
+        self.hw = self.meta[n: 3 * n].reshape(n, 2)
+        self.ref = self.meta[3 * n: 4 * n]
+        self.valid = self.meta[4 * n: 5 * n]
+        self.hand = self.meta[5 * n: 5 * n + 1]
+        self.counters = self.meta[5 * n + 1:]
+
+    def __getstate__(self):
+        # Sent to the workers, which attach to the same memory
+        state = self.__dict__.copy()
+        for k in ['data_shm', 'meta_shm', 'data', 'meta', 'keys', 'hw',
+                  'ref', 'valid', 'hand', 'counters']:
+            del state[k]
+        state['names'] = (self.data_shm.name, self.meta_shm.name)
+        return state
+
+    def __setstate__(self, state):
+        data_name, meta_name = state.pop('names')
+        self.__dict__.update(state)
+        self.data_shm = shared_memory.SharedMemory(name=data_name)
+        self.meta_shm = shared_memory.SharedMemory(name=meta_name)
+        self.attach()
+
+    def find(self, key: int) -> Optional[int]:
+        slots = np.flatnonzero((self.keys == key) & (self.valid == 1))
+        return int(slots[0]) if len(slots) else None
+
+    def get(self, img_key: str) -> Optional[Tuple[np.ndarray, int, int]]:
+        "Same output as `load_resized`, None if not cached"
+        key = key_of(img_key)
+        with self.lock:
+            slot = self.find(key)
+            if slot is None:
+                self.counters[1] += 1
+                return None
+            self.counters[0] += 1
+            self.ref[slot] = 1
+            h, w = self.hw[slot]
+            return self.data[slot].copy(), int(h), int(w)
+
+    def put(self, img_key: str, img: np.ndarray, h: int, w: int):
+        assert img.shape == self.slot_shape
+        key = key_of(img_key)
+        with self.lock:
+            if self.find(key) is not None:
+                # Added by another worker in the meantime
+                return
+            while True:
+                slot = int(self.hand[0])
+                self.hand[0] = (slot + 1) % self.num_slots
+                if not self.valid[slot] or not self.ref[slot]:
+                    break
+                self.ref[slot] = 0
+            self.data[slot] = img
+            self.keys[slot] = key
+            self.hw[slot] = [h, w]
+            self.ref[slot] = 0
+            self.valid[slot] = 1
+
+    def stats(self):
+        hits, misses = (int(c) for c in self.counters)
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': hits / max(hits + misses, 1),
+                'cached': int(self.valid.sum()), 'slots': self.num_slots}
+
+    def close(self):
+        # Drop the numpy views before closing the buffers
+        for k in ['data', 'meta', 'keys', 'hw', 'ref', 'valid', 'hand',
+                  'counters']:
+            self.__dict__.pop(k, None)
+        self.data_shm.close()
+        self.meta_shm.close()
+        if self.owner_pid == os.getpid():
+            self.data_shm.unlink()
+            self.meta_shm.unlink()
+            self.owner_pid = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,117 @@
+"""
+Synthetic grounding dataset with the same layout as refclef,
+for benchmarks and tests without the real downloads
+Run from the root directory, for example:
+python code/synth_data.py --num_imgs=1000 --refs_per_img=4
+and then use --ds_to_use='synthetic' (see configs/ds_info.json)
+"""
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Tuple
+
+import fire
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+COLORS = {
+    'red': (200, 30, 30), 'green': (30, 160, 40), 'blue': (30, 60, 200),
+    'yellow': (230, 210, 40), 'white': (240, 240, 240),
+    'black': (20, 20, 20), 'orange': (240, 140, 20),
+    'purple': (130, 40, 160),
+}
+OBJECTS = ['box', 'car', 'man', 'woman', 'tree', 'dog', 'house', 'sign',
+           'shirt', 'ball', 'chair', 'window', 'rock', 'bird']
+WORDS = ['the', 'on', 'left', 'right', 'top', 'bottom', 'near', 'big',
+         'small', 'middle', 'of', 'with', 'behind', 'front', 'far', 'second']
+
+
+def make_query(rng: np.random.RandomState, color: str, qlen: int) -> str:
+    "Query of qlen words which mentions the color of the box"
+    words = [color, rng.choice(OBJECTS)]
+    words += list(rng.choice(WORDS, max(qlen - 2, 0)))
+    return ' '.join(words[:qlen])
+
+
+def sample_qlen(rng: np.random.RandomState, qlen_dist: str, min_qlen: int,
+                max_qlen: int, qlen_mean: float) -> int:
+    if qlen_dist == 'uniform':
+        qlen = rng.randint(min_qlen, max_qlen + 1)
+    elif qlen_dist == 'poisson':
+        qlen = rng.poisson(qlen_mean)
+    else:
+        raise NotImplementedError(f'No query length distribution {qlen_dist}')
+    return int(np.clip(qlen, min_qlen, max_qlen))
+
+
+def draw_img(args: Tuple[Path, int, int, List, int]):
+    "Gradient background with a colored rectangle for every box"
+    img_file, w, h, boxes, seed = args
+    rng = np.random.RandomState(seed)
+    base = rng.randint(0, 256, 3)
+    grad = np.linspace(0.5, 1., w)[None, :, None] * np.ones((h, 1, 1))
+    img = (grad * base + rng.randint(0, 24, (h, w, 1))).astype(np.uint8)
+    for (x1, y1, x2, y2), color in boxes:
+        img[y1:y2, x1:x2] = COLORS[color]
+    Image.fromarray(img).save(img_file, quality=90)
+
+
+def synth_data(out_dir='./data/synthetic', num_imgs=200, refs_per_img=4,
+               img_size=(640, 480), size_jitter=0.2, qlen_dist='uniform',
+               min_qlen=1, max_qlen=12, qlen_mean=5., val_frac=0.1,
+               seed=0, nw=4):
+    """
+    Writes images/{i}.jpg and csv_dir/{train_flat,val,test}.csv
+    in the format read by ImgQuDataset for refclef.
+    num_imgs: number of images, split in train / val / test
+    refs_per_img: boxes (one query each) per image
+    img_size: (w, h), each side scaled by up to +-size_jitter
+    qlen_dist: 'uniform' in [min_qlen, max_qlen]
+    or 'poisson' with mean qlen_mean clipped to it
+    val_frac: fraction of the images in val and in test
+    """
+    out_dir = Path(out_dir)
+    (out_dir / 'images').mkdir(parents=True, exist_ok=True)
+    (out_dir / 'csv_dir').mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+
+    rows, draw_args = [], []
+    for i in range(num_imgs):
+        w, h = (int(s * rng.uniform(1 - size_jitter, 1 + size_jitter))
+                for s in img_size)
+        boxes = []
+        for _ in range(refs_per_img):
+            bw = rng.randint(max(w // 16, 2), w // 2)
+            bh = rng.randint(max(h // 16, 2), h // 2)
+            x1, y1 = rng.randint(0, w - bw), rng.randint(0, h - bh)
+            color = rng.choice(list(COLORS))
+            boxes.append(([x1, y1, x1 + bw, y1 + bh], color))
+            qlen = sample_qlen(rng, qlen_dist, min_qlen, max_qlen, qlen_mean)
+            rows.append({'img_id': f'{i}.jpg',
+                         'bbox': [x1, y1, x1 + bw, y1 + bh],
+                         'query': make_query(rng, color, qlen)})
+        draw_args.append((out_dir / 'images' / f'{i}.jpg', w, h, boxes,
+                          seed * num_imgs + i))
+
+    if nw > 0:
+        with Pool(nw) as pool:
+            pool.map(draw_img, draw_args, chunksize=16)
+    else:
+        for args in draw_args:
+            draw_img(args)
+
+    df = pd.DataFrame(rows)
+    num_val = int(round(num_imgs * val_frac))
+    img_num = df.img_id.str[:-4].astype(int)
+    splits = {
+        'test': img_num >= num_imgs - num_val,
+        'val': ((img_num >= num_imgs - 2 * num_val) &
+                (img_num < num_imgs - num_val)),
+    }
+    splits['train_flat'] = ~(splits['test'] | splits['val'])
+    for name, msk in splits.items():
+        df[msk].to_csv(out_dir / 'csv_dir' / f'{name}.csv', index=False)
+
+
+if __name__ == '__main__':
+    fire.Fire(synth_data)
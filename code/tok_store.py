@@ -0,0 +1,93 @@
+"""
+Queries converted offline to token ids
+The word vectors are kept in a single table shared by all the splits,
+so spacy is not needed at train or inference time
+"""
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+# Row 0 of the vector table is used for padding
+PAD_ID = 0
+
+
+def load_word_vecs(store_dir: Union[str, Path]) -> np.ndarray:
+    "Memory-mapped vocab_size x emb_dim table of word vectors"
+    return np.load(Path(store_dir) / 'vectors.npy', mmap_mode='r')
+
+
+class TokenStore:
+    """
+    Token ids of the queries of one csv file.
+    A row of the csv can have more than one query:
+    offsets[row]:offsets[row+1] are the queries of the row.
+    ids: num_queries x phrase_len int32, padded with PAD_ID
+    qlens: num_queries int32
+    """
+
+    def __init__(self, store_dir: Union[str, Path], csv_name: str):
+        self.store_dir = Path(store_dir)
+        self.csv_name = csv_name
+        self.ids = np.load(
+            self.store_dir / f'{csv_name}_ids.npy', mmap_mode='r')
+        self.qlens = np.load(
+            self.store_dir / f'{csv_name}_qlens.npy', mmap_mode='r')
+        self.offsets = np.load(
+            self.store_dir / f'{csv_name}_offsets.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def num_queries(self, row: int) -> int:
+        return int(self.offsets[row + 1] - self.offsets[row])
+
+    def get(self, row: int, qind: int = 0) -> Tuple[int, np.ndarray]:
+        "Returns qlen and the token ids of query `qind` of the `row`"
+        q = int(self.offsets[row]) + qind
+        return int(self.qlens[q]), np.array(self.ids[q])
+
+
+def build_token_store(store_dir: Union[str, Path],
+                      csv_queries: Dict[str, List[List[str]]],
+                      nlp: Callable[[str], Any], phrase_len: int = 50,
+                      emb_dim: int = 300):
+    """
+    Tokenizes the queries of every csv file and writes
+    the ids in the format read by `TokenStore`.
+    csv_queries: csv_name -> list of queries for each row
+    nlp: spacy pipeline, tokens need to have `text` and `vector`
+    The vocabulary and vector table are shared by all csv files
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    vocab = {'<pad>': PAD_ID}
+    vecs = [np.zeros(emb_dim, dtype=np.float32)]
+
+    for csv_name, row_queries in csv_queries.items():
+        offsets = np.zeros(len(row_queries) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(qs) for qs in row_queries])
+        ids = np.full((offsets[-1], phrase_len), PAD_ID, dtype=np.int32)
+        qlens = np.zeros(offsets[-1], dtype=np.int32)
+
+        q = 0
+        for queries in tqdm(row_queries, desc=csv_name):
+            for query in queries:
+                toks = nlp(query)[:phrase_len]
+                for t, tok in enumerate(toks):
+                    if tok.text not in vocab:
+                        vocab[tok.text] = len(vecs)
+                        vecs.append(np.asarray(tok.vector, dtype=np.float32))
+                    ids[q, t] = vocab[tok.text]
+                qlens[q] = len(toks)
+                q += 1
+
+        np.save(store_dir / f'{csv_name}_ids.npy', ids)
+        np.save(store_dir / f'{csv_name}_qlens.npy', qlens)
+        np.save(store_dir / f'{csv_name}_offsets.npy', offsets)
+
+    np.save(store_dir / 'vectors.npy', np.stack(vecs))
+    json.dump(sorted(vocab, key=vocab.get),
+              (store_dir / 'vocab.json').open('w'))
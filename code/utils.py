@@ -22,12 +22,21 @@ import json
 from fastprogress.fastprogress import master_bar, progress_bar
 import logging
 import pickle
+import queue
+import random
+import threading
 # from torch.utils.tensorboard import SummaryWriter
 from torch import distributed as dist
 from torch.distributed import ReduceOp
 from yacs.config import CfgNode as CN
 from anchors import tlbr2cthw
 
+# The checkpoints have more than tensors, torch >= 2.6 loads only
+# weights by default. weights_only is not known before torch 1.13
+TORCH_VERSION = tuple(int(v) for v in re.findall(r'\d+', torch.__version__)[:2])
+LOAD_FULL_KWARGS = {'weights_only': False} if TORCH_VERSION >= (1, 13) else {}
+
+
 def get_world_size():
     if not dist.is_available():
         return 1
@@ -105,7 +114,8 @@ def reduce_dict_corr(input_dict, nums):
     dist.reduce(nums, dst=0)
     if not is_main_process():
         return out_dict
-    out_dict_avg = {k: v / nums.item() for k, v in out_dict.items()}
+    # nums is 0 if no rank added a value (as AccumDict.avg)
+    out_dict_avg = {k: v / max(nums.item(), 1) for k, v in out_dict.items()}
     return out_dict_avg
 
 
@@ -162,6 +172,188 @@ class SmoothenDict:
         return self.smooth_vals[self.keys[0]].smooth
 
 
+class AccumDict:
+    """
+    Running means of values weighted by the number of samples.
+    The sums stay on the device until read
+    """
+
+    def __init__(self, keys: List[str], device: torch.device):
+        self.keys = keys
+        self.sums = {k: torch.zeros((), device=device) for k in keys}
+        self.num = torch.zeros((), device=device)
+
+    def add_value(self, val: Dict[str, torch.tensor], num: int):
+        for k in self.keys:
+            self.sums[k] += val[k].detach().float() * num
+        self.num += num
+
+    @property
+    def avg(self):
+        return {k: self.sums[k] / self.num.clamp(min=1) for k in self.keys}
+
+    @property
+    def avg1(self):
+        return self.sums[self.keys[0]] / self.num.clamp(min=1)
+
+
+def set_dl_epoch(dl: DataLoader, epoch: int):
+    "Samplers (or streaming datasets) seeded by the epoch need it to reshuffle"
+    if hasattr(dl.sampler, 'set_epoch'):
+        dl.sampler.set_epoch(epoch)
+    if hasattr(dl.batch_sampler, 'set_epoch'):
+        dl.batch_sampler.set_epoch(epoch)
+    if hasattr(dl.dataset, 'set_epoch'):
+        dl.dataset.set_epoch(epoch)
+
+
+def skip_batches(dl: DataLoader, num_batches: int) -> bool:
+    """
+    Makes the current epoch of dl start after `num_batches` batches,
+    without loading the skipped ones.
+    Returns False if the sampler can't do it
+    """
+    if hasattr(dl.batch_sampler, 'set_start'):
+        dl.batch_sampler.set_start(num_batches)
+    elif hasattr(dl.sampler, 'set_start'):
+        if dl.batch_size is None:
+            # The sampler yields batches
+            dl.sampler.set_start(num_batches)
+        else:
+            dl.sampler.set_start(num_batches * dl.batch_size)
+    else:
+        return False
+    return True
+
+
+def get_rng_states() -> Dict[str, Any]:
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict[str, Any]):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+# Also kept on the host as {key}_cpu, the lstm needs the lengths there
+HOST_COPY_KEYS = ['qlens']
+
+
+def batch_to_device(batch: Dict[str, Any], device: torch.device,
+                    non_blocking: bool = False) -> Dict[str, Any]:
+    "Moves the tensors of the batch, other fields (like sents) are kept"
+    out = {k: v.to(device, non_blocking=non_blocking)
+           if torch.is_tensor(v) else v for k, v in batch.items()}
+    for k in HOST_COPY_KEYS:
+        if k in batch and device.type != 'cpu':
+            out[f'{k}_cpu'] = batch[k]
+    return out
+
+
+class BatchPrefetcher:
+    """
+    Iterates over a DataLoader and returns batches on the `device`.
+    If `prefetch` then the copy of batch N+1 overlaps with the
+    compute on batch N:
+    on cuda, batches are pinned and copied on a side stream,
+    otherwise batches are staged by a background thread.
+    """
+
+    def __init__(self, dl: DataLoader, device: torch.device,
+                 prefetch: bool = True, num_prefetch: int = 2):
+        self.dl = dl
+        self.device = device
+        self.prefetch = prefetch
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.dl)
+
+    def __iter__(self):
+        if not self.prefetch:
+            return (batch_to_device(batch, self.device) for batch in self.dl)
+        if self.device.type == 'cuda':
+            return self.cuda_iter()
+        return self.thread_iter()
+
+    def pin(self, batch):
+        return {k: v.pin_memory()
+                if torch.is_tensor(v) and not v.is_pinned() else v
+                for k, v in batch.items()}
+
+    def cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        dl_iter = iter(self.dl)
+
+        def preload():
+            try:
+                batch = next(dl_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return batch_to_device(
+                    self.pin(batch), self.device, non_blocking=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            cur_stream = torch.cuda.current_stream(self.device)
+            cur_stream.wait_stream(stream)
+            batch = next_batch
+            # The memory was allocated on the side stream
+            for v in batch.values():
+                if torch.is_tensor(v) and v.is_cuda:
+                    v.record_stream(cur_stream)
+            next_batch = preload()
+            yield batch
+
+    def thread_iter(self):
+        batch_queue = queue.Queue(maxsize=self.num_prefetch)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def stage():
+            try:
+                for batch in self.dl:
+                    if stop.is_set():
+                        break
+                    put(batch_to_device(batch, self.device))
+            except Exception as e:
+                put(e)
+            put(done)
+
+        thread = threading.Thread(target=stage, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
 def compute_avg(inp: List, nums: torch.tensor) -> float:
     "Computes average given list of torch.tensor and numbers corresponding to them"
     return (torch.stack(inp) * nums).sum() / nums.sum()
@@ -217,6 +409,15 @@ class Learner:
         self.num_it = 0
         self.num_epoch = 0
         self.best_met = 0
+        # Batches done in the current epoch
+        self.epoch_it = 0
+        # Iteration checkpoint to continue from, used in fit
+        self.it_checkpoint = None
+        # Steps with a non-finite loss, kept on the device
+        # and only read when logging
+        self.num_nonfinite = torch.zeros((), dtype=torch.long,
+                                         device=self.device)
+        self.num_nonfinite_logged = 0
 
         # Resume if given a path
         if self.cfg['resume']:
@@ -224,6 +425,10 @@ class Learner:
                 resume_path=self.cfg['resume_path'],
                 load_opt=self.cfg['load_opt'])
 
+        # Resume in the middle of an epoch
+        if self.cfg['resume_it']:
+            self.load_it_checkpoint()
+
         # self.writer.add_text(tag='cfg', text_string=json.dumps(self.cfg),
             # global_step=self.num_epoch)
 
@@ -276,6 +481,10 @@ class Learner:
         # Saves the trained model
         self.model_file = Path(self.data.path) / 'models' / f'{self.uid}.pth'
 
+        # Saves the training state every save_it_every iterations
+        self.it_model_file = (
+            Path(self.data.path) / 'models' / f'{self.uid}_it.pth')
+
         # Saves the output predictions
         self.predictions_dir = Path(
             self.data.path) / 'predictions' / f'{self.uid}'
@@ -384,6 +593,11 @@ class Learner:
 
 
 
+    def get_batches(self, dl: DataLoader) -> BatchPrefetcher:
+        "Batches of the DataLoader on self.device"
+        return BatchPrefetcher(dl, self.device,
+                               prefetch=self.cfg['use_prefetcher'])
+
     def validate(self, db: Optional[DataLoader] = None,
                  mb=None) -> List[torch.tensor]:
         "Validation loop, done after every epoch"
@@ -396,10 +610,7 @@ class Learner:
             val_losses = {k: [] for k in self.loss_keys}
             eval_metrics = {k: [] for k in self.met_keys}
             nums = []
-            for batch in progress_bar(db, parent=mb):
-                for b in batch.keys():
-                    if b != 'sents':
-                        batch[b] = batch[b].to(self.device)
+            for batch in progress_bar(self.get_batches(db), parent=mb):
                 out = self.mdl(batch)
                 out_loss = self.loss_fn(out, batch)
 
@@ -428,51 +639,103 @@ class Learner:
             eval_metric = reduce_dict_corr(eval_metric, tot_nums)
             return val_loss, eval_metric, predicted_box_dict_list
 
+    def metric_rows(self, annot: torch.tensor) -> torch.tensor:
+        "Random rows of the batch used for the train metrics"
+        bs = annot.size(0)
+        num = max(int(round(bs * self.cfg['trn_met_frac'])), 1)
+        if num >= bs:
+            return torch.arange(bs, device=annot.device)
+        return torch.randperm(bs, device=annot.device)[:num]
+
+    def drop_nonfinite_grads(self, finite: torch.tensor):
+        """
+        Zeroes the gradients of a step with a non-finite loss.
+        Done on the device for every step, instead of checking
+        the loss on the host.
+        Unlike replacing the losses on the host, the att_loss
+        gradients of the step are dropped as well: the backward of
+        the non-finite losses can already have spoilt the shared ones
+        """
+        # finite is uint8 before torch 1.2, so not negated with ~
+        bad = (finite == 0).long()
+        if get_world_size() > 1:
+            # The gradients are averaged, a bad loss on one rank
+            # spoils them on all
+            dist.all_reduce(bad, op=ReduceOp.MAX)
+        # bool mask (uint8 before torch 1.2)
+        bad_msk = bad > 0
+        for p in self.mdl.parameters():
+            if p.grad is not None:
+                p.grad.masked_fill_(bad_msk, 0)
+        self.num_nonfinite += bad
+
+    def log_nonfinite(self):
+        num_nonfinite = int(self.num_nonfinite)
+        if num_nonfinite > self.num_nonfinite_logged:
+            self.logger.warning(
+                f'Num_it {self.num_it} {num_nonfinite} steps with a '
+                f'non-finite loss so far, their gradients were dropped')
+            self.num_nonfinite_logged = num_nonfinite
+
     def train_epoch(self, mb) -> List[torch.tensor]:
         "One epoch used for training"
         self.mdl.train()
         # trn_loss = SmoothenValue(0.9)
         trn_loss = SmoothenDict(self.loss_keys, 0.9)
-        trn_acc = SmoothenDict(self.met_keys, 0.9)
+        # Train metrics of every trn_met_every-th step
+        # on a trn_met_frac fraction of its batch
+        trn_acc = AccumDict(self.met_keys, self.device)
 
-        for batch_id, batch in enumerate(progress_bar(self.data.train_dl, parent=mb)):
+        for batch_id, batch in enumerate(progress_bar(
+                self.get_batches(self.data.train_dl), parent=mb)):
             # for batch_id, batch in progress_bar(QueueIterator(batch_queue), parent=mb):
             # for batch_id, batch in QueueIterator(batch_queue):
             # Increment number of iterations
             self.num_it += 1
-            for b in batch.keys():
-                if b != 'sents':
-                    batch[b] = batch[b].to(self.device)
+            self.epoch_it += 1
             self.optimizer.zero_grad()
             out = self.mdl(batch)
             out_loss = self.loss_fn(out, batch)
             loss = out_loss[self.loss_keys[0]]
             loss = loss.mean()
             loss.backward()
+            if 'finite' in out_loss:
+                self.drop_nonfinite_grads(out_loss['finite'])
             self.optimizer.step()
-            metric = self.eval_fn(out, batch)
+            if self.num_it % self.cfg['trn_met_every'] == 0:
+                rows = self.metric_rows(batch['annot'])
+                metric = self.eval_fn(out, batch, rows=rows)
+                trn_acc.add_value(metric, len(rows))
 
             # Returns original dictionary if not distributed parallel
             # loss_reduced = reduce_dict(out_loss, average=True)
             # metric_reduced = reduce_dict(metric, average=True)
             # print(trn_loss)
             trn_loss.add_value(out_loss)
-            trn_acc.add_value(metric)
 
             # self.writer.add_scalar(
             #     tag='trn_loss', scalar_value=out_loss[self.loss_keys[0]],
             #     global_step=self.num_it)
-            comment_to_print = f'LossB {loss: .4f} | SmLossB {trn_loss.smooth1: .4f} | AccB {trn_acc.smooth1: .4f}'
-            mb.child.comment = comment_to_print
-            if self.num_it % 2 == 0:
+            # Printing the values waits for the device,
+            # so only done every log_every steps
+            if self.num_it % self.cfg['log_every'] == 0:
+                comment_to_print = f'LossB {loss: .4f} | SmLossB {trn_loss.smooth1: .4f} | AccB {trn_acc.avg1: .4f}'
+                mb.child.comment = comment_to_print
                 self.logger.debug(f'Num_it {self.num_it} {comment_to_print}')
+                self.log_nonfinite()
             del out_loss
             del loss
+            # Not after the last batch, the epoch is complete then
+            if (self.cfg['save_it_every'] and
+                    self.num_it % self.cfg['save_it_every'] == 0 and
+                    batch_id + 1 < len(self.data.train_dl)):
+                self.save_it_checkpoint()
             # print(f'Done {batch_id}')
         del batch
         self.optimizer.zero_grad()
+        self.log_nonfinite()
         out_loss = reduce_dict(trn_loss.smooth, average=True)
-        out_met = reduce_dict(trn_acc.smooth, average=True)
+        out_met = reduce_dict_corr(trn_acc.avg, trn_acc.num)
         # return trn_loss.smooth, trn_acc.smooth
         return out_loss, out_met
 
@@ -489,7 +752,7 @@ class Learner:
                 f'No existing model in {mfile}, starting from scratch')
             return
         try:
-            checkpoint = torch.load(open(mfile, 'rb'))
+            checkpoint = torch.load(open(mfile, 'rb'), **LOAD_FULL_KWARGS)
             self.logger.info(f'Loaded model from {mfile} Correctly')
         except OSError as e:
             self.logger.error(
@@ -541,6 +804,51 @@ class Learner:
         }
         torch.save(checkpoint, self.model_file.open('wb'))
 
+    @exec_func_if_main_proc
+    def save_it_checkpoint(self):
+        """
+        Everything needed to continue training from the current iteration:
+        model, optimizer, scheduler, position in the epoch and RNG states.
+        The RNG states are those of the main process
+        """
+        checkpoint = {
+            'model_state_dict': self.mdl.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.lr_scheduler.state_dict(),
+            'num_it': self.num_it,
+            'num_epoch': self.num_epoch,
+            'epoch_it': self.epoch_it,
+            'best_met': self.best_met,
+            'rng_states': get_rng_states(),
+            'cfgtxt': json.dumps(self.cfg),
+        }
+        # Write and rename, so that preemption while saving
+        # leaves the previous checkpoint intact
+        tmp_file = self.it_model_file.with_suffix('.tmp')
+        torch.save(checkpoint, tmp_file.open('wb'))
+        tmp_file.replace(self.it_model_file)
+
+    def load_it_checkpoint(self):
+        "Loads the checkpoint of save_it_checkpoint, if any"
+        if not self.it_model_file.exists():
+            self.logger.info(
+                f'No iteration checkpoint in {self.it_model_file}')
+            return
+        checkpoint = torch.load(self.it_model_file.open('rb'),
+                                **LOAD_FULL_KWARGS)
+        self.mdl.load_state_dict(checkpoint['model_state_dict'])
+        self.num_it = checkpoint['num_it']
+        # fit increments it before starting the epoch
+        self.num_epoch = checkpoint['num_epoch'] - 1
+        self.epoch_it = checkpoint['epoch_it']
+        self.best_met = checkpoint['best_met']
+        set_rng_states(checkpoint['rng_states'])
+        # Optimizer and scheduler are loaded once created in fit
+        self.it_checkpoint = checkpoint
+        self.logger.info(
+            f'Resuming epoch {checkpoint["num_epoch"]} after '
+            f'{self.epoch_it} batches from {self.it_model_file}')
+
     # @exec_func_if_main_proc
     def update_prediction_file(self, predictions, pred_file):
         rank = self.rank
@@ -624,6 +932,12 @@ class Learner:
         # Initialize scheduler
         # Prepare scheduler may need to re-written as per use
         self.lr_scheduler = self.prepare_scheduler(self.optimizer)
+        if self.it_checkpoint is not None:
+            self.optimizer.load_state_dict(
+                self.it_checkpoint['optimizer_state_dict'])
+            self.lr_scheduler.load_state_dict(
+                self.it_checkpoint['scheduler_state_dict'])
+            self.it_checkpoint = None
 
         # Write the top row display
         # mb.write(self.log_keys, table=True)
@@ -639,8 +953,17 @@ class Learner:
                     self.update_log_file("EPOCH: {}, LR={}".format(epoch, param['lr']))
                     break
                 self.num_epoch += 1
+                set_dl_epoch(self.data.train_dl, self.num_epoch)
+                if self.epoch_it > 0:
+                    # Resumed from an iteration checkpoint
+                    if not skip_batches(self.data.train_dl, self.epoch_it):
+                        self.logger.warning(
+                            'Sampler can not skip batches, '
+                            'restarting the epoch')
+                        self.epoch_it = 0
                 train_loss, train_acc = self.train_epoch(mb)
 
+                self.epoch_it = 0
                 valid_loss, valid_acc, predictions = self.validate(
                     self.data.valid_dl, mb)
 
@@ -740,10 +1063,7 @@ class Learner:
 
     def overfit_batch(self, epochs: int, lr: float):
         "Sanity check to see if model overfits on a batch"
-        batch = next(iter(self.data.train_dl))
-        for b in batch.keys():
-            if b != 'sents':
-                batch[b] = batch[b].to(self.device)
+        batch = batch_to_device(next(iter(self.data.train_dl)), self.device)
         self.mdl.train()
         opt = self.prepare_optimizer(epochs, lr)
 